@@ -0,0 +1,77 @@
+import random
+
+PRODUCTS = [
+    "АТТ ПБ экзотик", "Яблоки", "Молоко", "Конфеты", "Кефир", "Сок апельсиновый",
+    "Вода минеральная", "Хлеб белый", "Chocolate", "Coffee beans", "Сыр российский", "Йогурт",
+]
+SIZE_SUFFIXES = ["0,25л", "0,5л", "1л", "1,5л", "200г", "500г", "1кг", ""]
+SEPARATORS = [" - ", ": ", " -", "- ", ":"]
+
+
+def make_rng(seed=1337):
+    return random.Random(seed)
+
+def make_category(rng):
+    product = rng.choice(PRODUCTS)
+    suffix = rng.choice(SIZE_SUFFIXES)
+    name = f"{product} {suffix}".strip()
+    if rng.random() < 0.3:
+        name += f" №{rng.randint(1, 500)}"
+    return name
+
+def make_categories(rng, count):
+    categories = []
+    seen = set()
+    while len(categories) < count:
+        name = make_category(rng)
+        if name not in seen:
+            seen.add(name)
+            categories.append(name)
+    return categories
+
+def make_variant(rng, name):
+    # Тот же товар в другой записи: лишние пробелы или другая единица после числа
+    variant = name
+    if rng.random() < 0.5:
+        variant = variant.replace(" ", "  ", 1)
+    if rng.random() < 0.3:
+        variant = variant.replace("л", "L", 1)
+    return variant
+
+def make_line(rng, categories, new_ratio=0.1):
+    if not categories or rng.random() < new_ratio:
+        name = make_category(rng)
+    else:
+        name = make_variant(rng, rng.choice(categories))
+    return f"{name}{rng.choice(SEPARATORS)}{rng.randint(-5, 200)}"
+
+def make_report(rng, categories, lines=10, junk_ratio=0.05):
+    report_lines = []
+    for _ in range(lines):
+        if rng.random() < junk_ratio:
+            report_lines.append(rng.choice(["итого", "", "   ", "спасибо!"]))
+        else:
+            report_lines.append(make_line(rng, categories))
+    return "\n".join(report_lines)
+
+def make_user_entry(rng, categories, history_steps=6):
+    values = {name: rng.randint(0, 1000) for name in rng.sample(categories, min(len(categories), 30))}
+    history = [[[name, rng.randint(1, 50)] for name in rng.sample(list(values), min(len(values), 3))]
+               for _ in range(rng.randint(0, history_steps))]
+    return {
+        'count': len(history),
+        'values': values,
+        'history': history,
+        'qr_codes': {'next_qr_id': 1, 'codes': []},
+    }
+
+def make_users(rng, count, categories):
+    return {uid: make_user_entry(rng, categories) for uid in range(1, count + 1)}
+
+def make_add_entries(rng, users, count, categories, depth=6):
+    user_ids = list(users)
+    entries = []
+    for _ in range(count):
+        items = [[name, rng.randint(1, 50)] for name in rng.sample(categories, 3)]
+        entries.append({'op': 'add', 'user': rng.choice(user_ids), 'items': items, 'depth': depth})
+    return entries
@@ -0,0 +1,403 @@
+import argparse
+import asyncio
+import datetime
+import gc
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_DIR, "benchmarks", "results")
+
+# Лимиты отправки и отложенная запись мешают измерять сам бот, поэтому на время замеров они отключены
+BENCH_ENV = {
+    "BOT_TOKEN": "123456:benchmark",
+    "STORAGE_BACKEND": "json",
+    "LOG_LEVEL": "INFO",
+    "SEND_GLOBAL_RATE": "1000000",
+    "SEND_CHAT_RATE": "1000000",
+    "SEND_CHAT_BURST": "1000000",
+    "COALESCE_WINDOW": "0",
+}
+
+sys.path.insert(0, REPO_DIR)
+
+from benchmarks.generators import (make_add_entries, make_categories, make_category, make_line, make_report,
+                                   make_rng, make_users, make_variant)
+
+# Размеры полного прогона; --quick делит их на 10
+SIZES = {
+    'similarity_pairs': 20000,
+    'categories': 200,
+    'lookups': 5000,
+    'lines': 50000,
+    'reports': 5000,
+    'users': 1000,
+    'storage_batches': 500,
+    'storage_batch_size': 20,
+    'compacts': 20,
+    'log_records': 50000,
+    'qr_texts': 200,
+    'updates': 3000,
+    'dispatch_users': 300,
+}
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS.append((name, func))
+        return func
+    return register
+
+
+def percentile(sorted_samples, fraction):
+    if not sorted_samples:
+        return 0
+    position = min(len(sorted_samples) - 1, int(round(fraction * (len(sorted_samples) - 1))))
+    return sorted_samples[position]
+
+def summarize(samples_ns, total_ns, **extra):
+    samples_ns = sorted(samples_ns)
+    ops = len(samples_ns)
+    result = {
+        'ops': ops,
+        'ops_per_sec': round(ops / (total_ns / 1e9), 1) if total_ns else 0.0,
+        'mean_us': round(sum(samples_ns) / ops / 1000, 3) if ops else 0.0,
+        'p50_us': round(percentile(samples_ns, 0.50) / 1000, 3),
+        'p99_us': round(percentile(samples_ns, 0.99) / 1000, 3),
+        'max_us': round(samples_ns[-1] / 1000, 3) if ops else 0.0,
+    }
+    result.update(extra)
+    return result
+
+def measure(func, calls, warmup=50):
+    for args in calls[:warmup]:
+        func(*args)
+    gc.collect()
+    samples = []
+    perf_counter_ns = time.perf_counter_ns
+    started = perf_counter_ns()
+    for args in calls:
+        call_started = perf_counter_ns()
+        func(*args)
+        samples.append(perf_counter_ns() - call_started)
+    return summarize(samples, perf_counter_ns() - started)
+
+async def measure_async(func, calls):
+    gc.collect()
+    samples = []
+    perf_counter_ns = time.perf_counter_ns
+    started = perf_counter_ns()
+    for args in calls:
+        call_started = perf_counter_ns()
+        await func(*args)
+        samples.append(perf_counter_ns() - call_started)
+    return summarize(samples, perf_counter_ns() - started)
+
+
+@benchmark("string_similarity")
+def bench_string_similarity(rng, sizes):
+    from matching import normalize_category_name, string_similarity
+    categories = make_categories(rng, sizes['categories'])
+    pairs = [(normalize_category_name(rng.choice(categories)), normalize_category_name(rng.choice(categories)))
+             for _ in range(sizes['similarity_pairs'])]
+    return measure(string_similarity, pairs)
+
+@benchmark("normalize_category_name")
+def bench_normalize(rng, sizes):
+    from matching import normalize_category_name
+    categories = make_categories(rng, sizes['categories'])
+    # Замер без lru_cache: в реальной работе кэш помогает, но стоимость промаха важнее
+    names = [(make_variant(rng, rng.choice(categories)),) for _ in range(sizes['lookups'])]
+    return measure(normalize_category_name.__wrapped__, names)
+
+@benchmark("find_similar_category")
+def bench_find_similar_category(rng, sizes):
+    import bot
+    from matching import CategoryIndex
+    categories = make_categories(rng, sizes['categories'])
+    values = dict.fromkeys(categories, 0)
+    index = CategoryIndex()
+    lookups = [(make_variant(rng, rng.choice(categories)) if rng.random() < 0.8 else make_category(rng),
+                values, bot.SIMILARITY_THRESHOLD, index) for _ in range(sizes['lookups'])]
+    return measure(bot.find_similar_category, lookups, warmup=0)
+
+@benchmark("parse_line")
+def bench_parse_line(rng, sizes):
+    from parsing import parse_line
+    categories = make_categories(rng, sizes['categories'])
+    lines = [(make_line(rng, categories),) for _ in range(sizes['lines'])]
+    return measure(parse_line, lines)
+
+@benchmark("parse_message")
+def bench_parse_message(rng, sizes):
+    from parsing import parse_message
+    categories = make_categories(rng, sizes['categories'])
+    reports = [(make_report(rng, categories, lines=rng.randint(1, 30)),) for _ in range(sizes['reports'])]
+    return measure(parse_message, reports)
+
+def write_json_snapshot(path, users):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({str(uid): user_entry for uid, user_entry in users.items()}, f, ensure_ascii=False)
+
+@benchmark("json_storage_apply_batch")
+def bench_json_apply_batch(rng, sizes):
+    from storage import JsonStorage
+    categories = make_categories(rng, sizes['categories'])
+    users = make_users(rng, sizes['users'], categories)
+    batch_size = sizes['storage_batch_size']
+    entries = make_add_entries(rng, users, sizes['storage_batches'] * batch_size, categories)
+    batches = [(entries[i:i + batch_size],) for i in range(0, len(entries), batch_size)]
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = os.path.join(work_dir, "user_data.json")
+        write_json_snapshot(path, users)
+        # Порог сжатия выше числа операций: замеряется только дозапись журнала
+        storage = JsonStorage(path, path + ".journal", compact_threshold=len(entries) + 1)
+        storage.open()
+        try:
+            return measure(storage.apply_batch, batches, warmup=0)
+        finally:
+            storage.close()
+
+@benchmark("json_storage_compact")
+def bench_json_compact(rng, sizes):
+    from storage import JsonStorage
+    categories = make_categories(rng, sizes['categories'])
+    users = make_users(rng, sizes['users'], categories)
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = os.path.join(work_dir, "user_data.json")
+        write_json_snapshot(path, users)
+        storage = JsonStorage(path, path + ".journal")
+        storage.open()
+        try:
+            return measure(storage.compact, [()] * sizes['compacts'], warmup=1)
+        finally:
+            storage.close()
+
+@benchmark("snapshot_storage_compact")
+def bench_snapshot_compact(rng, sizes):
+    from storage import JsonStorage, SnapshotStorage, migrate_json_to_snapshot
+    categories = make_categories(rng, sizes['categories'])
+    users = make_users(rng, sizes['users'], categories)
+    with tempfile.TemporaryDirectory() as work_dir:
+        json_path = os.path.join(work_dir, "user_data.json")
+        write_json_snapshot(json_path, users)
+        path = os.path.join(work_dir, "user_data.snap")
+        storage = SnapshotStorage(path, path + ".journal")
+        storage.open()
+        try:
+            migrate_json_to_snapshot(JsonStorage(json_path, json_path + ".journal"), storage)
+            return measure(storage.compact, [()] * sizes['compacts'], warmup=1)
+        finally:
+            storage.close()
+
+@benchmark("snapshot_storage_load_user")
+def bench_snapshot_load_user(rng, sizes):
+    from storage import JsonStorage, SnapshotStorage, migrate_json_to_snapshot
+    categories = make_categories(rng, sizes['categories'])
+    users = make_users(rng, sizes['users'], categories)
+    user_ids = list(users)
+    with tempfile.TemporaryDirectory() as work_dir:
+        json_path = os.path.join(work_dir, "user_data.json")
+        write_json_snapshot(json_path, users)
+        path = os.path.join(work_dir, "user_data.snap")
+        storage = SnapshotStorage(path, path + ".journal")
+        storage.open()
+        try:
+            migrate_json_to_snapshot(JsonStorage(json_path, json_path + ".journal"), storage)
+            return measure(storage.load_user, [(rng.choice(user_ids),) for _ in range(sizes['lookups'])])
+        finally:
+            storage.close()
+
+@benchmark("sqlite_storage_apply_batch")
+def bench_sqlite_apply_batch(rng, sizes):
+    from storage import JsonStorage, SqliteStorage, migrate_json_to_sqlite
+    categories = make_categories(rng, sizes['categories'])
+    users = make_users(rng, sizes['users'], categories)
+    batch_size = sizes['storage_batch_size']
+    entries = make_add_entries(rng, users, sizes['storage_batches'] * batch_size, categories)
+    batches = [(entries[i:i + batch_size],) for i in range(0, len(entries), batch_size)]
+    with tempfile.TemporaryDirectory() as work_dir:
+        json_path = os.path.join(work_dir, "user_data.json")
+        write_json_snapshot(json_path, users)
+        storage = SqliteStorage(os.path.join(work_dir, "user_data.db"))
+        storage.open()
+        try:
+            migrate_json_to_sqlite(JsonStorage(json_path, json_path + ".journal"), storage)
+            return measure(storage.apply_batch, batches, warmup=0)
+        finally:
+            storage.close()
+
+@benchmark("log_message")
+def bench_log_message(rng, sizes):
+    from logger import log_message, log_writer
+    calls = [("INFO", rng.randint(1, 10000), "bench", "Обработаны значения", f"Категория: {rng.randint(0, 1000)}")
+             for _ in range(sizes['log_records'])]
+    result = measure(log_message, calls)
+    # Сколько записей фоновый поток успел разобрать за время замера
+    result['queue_backlog'] = log_writer.queue.qsize()
+    return result
+
+@benchmark("log_message_filtered")
+def bench_log_message_filtered(rng, sizes):
+    from logger import log_message
+    calls = [("DEBUG", rng.randint(1, 10000), "bench", "Состояние", "отфильтровано порогом")
+             for _ in range(sizes['log_records'])]
+    return measure(log_message, calls)
+
+@benchmark("qr_render")
+def bench_qr_render(rng, sizes):
+    from qr import render_qr_png
+    categories = make_categories(rng, sizes['categories'])
+    texts = [(f"{rng.choice(categories)} {rng.randint(0, 10 ** 9)}",) for _ in range(sizes['qr_texts'])]
+    return measure(render_qr_png, texts, warmup=5)
+
+
+def make_fake_session():
+    from aiogram.client.session.base import BaseSession
+    from aiogram.methods import SendMessage
+    from aiogram.types import Chat, Message
+
+    class FakeSession(BaseSession):
+        # Отвечает на запросы к Bot API сразу, без сети: замеряется только работа бота
+        def __init__(self):
+            super().__init__()
+            self.requests = 0
+
+        async def make_request(self, bot, method, timeout=None):
+            self.requests += 1
+            if isinstance(method, SendMessage):
+                return Message(message_id=self.requests, date=datetime.datetime.now(),
+                               chat=Chat(id=method.chat_id, type="private"), text=method.text)
+            return True
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            yield b""
+
+        async def close(self):
+            pass
+
+    return FakeSession()
+
+def make_update(update_id, user_id, text):
+    from aiogram.types import Chat, Message, Update, User
+    return Update(update_id=update_id, message=Message(
+        message_id=update_id, date=datetime.datetime.now(), text=text,
+        chat=Chat(id=user_id, type="private"),
+        from_user=User(id=user_id, is_bot=False, first_name="Bench", username=f"bench{user_id}"),
+    ))
+
+@benchmark("dispatch_process_message")
+def bench_dispatch(rng, sizes):
+    import bot
+    bot_instance, dispatcher = bot.create_app()
+    categories = make_categories(rng, sizes['categories'])
+    updates = [(bot_instance, make_update(update_id, rng.randint(1, sizes['dispatch_users']),
+                                     make_report(rng, categories, lines=rng.randint(1, 10))))
+               for update_id in range(1, sizes['updates'] + 1)]
+
+    async def run():
+        session = make_fake_session()
+        bot_instance.session = session
+        bot.load_all_user_data()
+        bot.persistence.start()
+        try:
+            result = await measure_async(dispatcher.feed_update, updates)
+        finally:
+            await bot.persistence.stop()
+            bot.storage.close()
+        result['api_requests'] = session.requests
+        return result
+
+    return asyncio.run(run())
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(results):
+    print(f"{'benchmark':<28} {'ops':>8} {'ops/sec':>12} {'p50 µs':>10} {'p99 µs':>10}")
+    for name, result in results.items():
+        print(f"{name:<28} {result['ops']:>8} {result['ops_per_sec']:>12.1f} {result['p50_us']:>10.1f} {result['p99_us']:>10.1f}")
+
+def print_comparison(results, baseline_path):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"\nСравнение с {baseline_path} (коммит {baseline['meta'].get('commit')}):")
+    print(f"{'benchmark':<28} {'ops/sec':>10} {'p99':>10}")
+    for name, result in results.items():
+        old = baseline['results'].get(name)
+        if not old or not old['ops_per_sec'] or not old['p99_us']:
+            continue
+        throughput = result['ops_per_sec'] / old['ops_per_sec']
+        tail = result['p99_us'] / old['p99_us']
+        print(f"{name:<28} {throughput:>9.2f}x {tail:>9.2f}x")
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры горячих путей бота")
+    parser.add_argument("--quick", action="store_true", help="прогон в 10 раз меньше для быстрой проверки")
+    parser.add_argument("--only", action="append", default=[], help="запустить только замеры с этим префиксом")
+    parser.add_argument("--seed", type=int, default=1337)
+    parser.add_argument("--output", help="куда записать JSON (по умолчанию benchmarks/results/<коммит>.json)")
+    parser.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    args = parser.parse_args()
+
+    sizes = {name: max(1, size // 10) if args.quick else size for name, size in SIZES.items()}
+    sizes['categories'] = max(sizes['categories'], 20)
+
+    os.environ.update(BENCH_ENV)
+    work_dir = tempfile.mkdtemp(prefix="counter_bench_")
+    os.chdir(work_dir)
+    import logger
+    logger.log_writer.console = False
+
+    results = {}
+    try:
+        for name, func in BENCHMARKS:
+            if args.only and not any(name.startswith(prefix) for prefix in args.only):
+                continue
+            print(f"... {name}", file=sys.stderr)
+            results[name] = func(make_rng(args.seed), sizes)
+    finally:
+        logger.shutdown_logging()
+        os.chdir(REPO_DIR)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    commit = git_commit()
+    report = {
+        'meta': {
+            'commit': commit,
+            'timestamp': datetime.datetime.now().isoformat(timespec="seconds"),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'seed': args.seed,
+            'quick': args.quick,
+            'sizes': sizes,
+        },
+        'results': results,
+    }
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{(commit or 'nocommit')[:12]}{'_quick' if args.quick else ''}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print_results(results)
+    print(f"\nРезультаты записаны в {output}")
+    if args.compare:
+        print_comparison(results, args.compare)
+
+if __name__ == '__main__':
+    main()
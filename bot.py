@@ -1,176 +1,299 @@
-from aiogram import Bot, Dispatcher, types, F
+import time
+
+# Отсчет замера запуска начинается до тяжелых импортов aiogram
+STARTED_AT = time.perf_counter()
+
+from aiogram import Bot, Dispatcher, Router, types, F
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, BufferedInputFile
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 import asyncio
-import re
 import datetime
+import threading
 import os
-import json
-import difflib
-import qrcode
-from io import BytesIO
 import traceback
-from threading import RLock
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from sys import intern
 from dotenv import load_dotenv
+from export import (ALL_USERS_HEADER, HISTORY_HEADER, TOTALS_HEADER, CsvStreamFile,
+                    iter_all_users_rows, iter_history_rows, iter_totals_rows, make_csv_file)
+from locks import UserLockRegistry
+from matching import CategoryIndex, normalize_category_name
+from metrics import HandlerTimingMiddleware, MetricsRegistry
+from models import Addition, UserState
+from parsing import parse_message
+from logger import Colors, configure_logging, log_enabled, log_message, log_writer, shutdown_logging
+from persistence import PersistenceWorker
+from profiling import PROFILE_MODES, ProfilerSession, UpdateCountMiddleware
+from replies import render_totals, split_message
+from sender import PRIORITY_PHOTO, SendScheduler
+from startup import ReadinessGate, StartupTimer
+from qr import QrCache, QrRenderer, qr_cache_key
+from qr_repository import QrRepository
+from storage import (JsonStorage, SnapshotStorage, SqliteStorage, migrate_json_to_snapshot, migrate_json_to_sqlite,
+                     migrate_to_shard)
+
+load_dotenv()
 
 class QRStates(StatesGroup):
     waiting_for_qr_text = State()
 
-class Colors:
-    RESET = "\033[0m"
-    BOLD = "\033[1m"
-    UNDERLINE = "\033[4m"
-    
-    BLACK = "\033[30m"
-    RED = "\033[31m"
-    GREEN = "\033[32m"
-    YELLOW = "\033[33m"
-    BLUE = "\033[34m"
-    MAGENTA = "\033[35m"
-    CYAN = "\033[36m"
-    WHITE = "\033[37m"
-    
-    BG_BLACK = "\033[40m"
-    BG_RED = "\033[41m"
-    BG_GREEN = "\033[42m"
-    BG_YELLOW = "\033[43m"
-    BG_BLUE = "\033[44m"
-    BG_MAGENTA = "\033[45m"
-    BG_CYAN = "\033[46m"
-    BG_WHITE = "\033[47m"
-
 MAX_MESSAGES = 6
 SIMILARITY_THRESHOLD = 0.9
-
-LOG_DIR = "logs"
-QR_CODE_DIR = "qrcodes"
-LOG_FILE = os.path.join(LOG_DIR, f"bot_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
-USER_DATA_FILE = "user_data.json"
-USER_DATA_TEMP_FILE = "user_data.tmp"
-
-data_lock = RLock()
-
-os.makedirs(LOG_DIR, exist_ok=True)
-os.makedirs(QR_CODE_DIR, exist_ok=True)
-
-def log_message(message_type, user_id=None, username=None, action=None, details=None):
-    current_time = datetime.datetime.now().strftime("%H:%M:%S")
-    
-    color_code = Colors.RESET
-    if message_type == "ERROR":
-        color_code = Colors.RED
-    elif message_type == "WARNING":
-        color_code = Colors.YELLOW
-    elif message_type == "COMMAND":
-        color_code = Colors.GREEN
-    elif message_type == "MESSAGE":
-        color_code = Colors.CYAN
-    elif message_type == "INFO":
-        color_code = Colors.WHITE
-    elif message_type == "SYSTEM":
-        color_code = Colors.MAGENTA
-    
-    user_str = f"{user_id}" if user_id else "---"
-    
-    username_str = username or "---"
-    
-    log_str = f"{current_time} {color_code}{message_type.ljust(7)}{Colors.RESET}"
-    log_str += f" | {user_str.ljust(10)} | {username_str.ljust(12)}"
-    
-    if action:
-        log_str += f" | {action}"
-    
-    if details:
-        log_str += f": {details}"
-    
-    print(log_str)
-    
-    file_log = {
-        "time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "type": message_type,
-        "user_id": user_id,
-        "username": username,
-        "action": action,
-        "details": details
-    }
-    
-    with open(LOG_FILE, "a", encoding="utf-8") as f:
-        f.write(json.dumps(file_log, ensure_ascii=False) + "\n")
-
-def load_all_user_data():
-    global user_data
-    with data_lock:
+UNDO_DEPTH = max(1, int(os.getenv("UNDO_DEPTH", str(MAX_MESSAGES))))
+MAX_RESIDENT_USERS = max(1, int(os.getenv("MAX_RESIDENT_USERS", "10000")))
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "0"))
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+ADMIN_IDS = {int(admin_id) for admin_id in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if admin_id}
+
+# При запуске через supervisor.py каждый процесс ведет своих пользователей (user_id % SHARD_COUNT) в своих файлах
+SHARD_COUNT = max(1, int(os.getenv("SHARD_COUNT", "1")))
+SHARD_ID = int(os.getenv("SHARD_ID", "0"))
+SHARD_SUFFIX = f".shard{SHARD_ID}" if SHARD_COUNT > 1 else ""
+
+LOG_DIR = os.path.join("logs", f"shard{SHARD_ID}") if SHARD_COUNT > 1 else "logs"
+# У каждого шарда свой кэш QR: общий file_ids.json и LRU файлов процессы затирали бы друг у друга
+QR_CODE_DIR = os.path.join("qrcodes", f"shard{SHARD_ID}") if SHARD_COUNT > 1 else "qrcodes"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "1.0"))
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_ROTATE_HOURS = float(os.getenv("LOG_ROTATE_HOURS", "24"))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "10"))
+SHARED_USER_DATA_FILE = "user_data.json"
+SHARED_USER_DATA_JOURNAL_FILE = "user_data.journal"
+SHARED_USER_DATA_DB_FILE = "user_data.db"
+SHARED_USER_DATA_SNAPSHOT_FILE = "user_data.snap"
+SHARED_USER_DATA_SNAPSHOT_JOURNAL_FILE = "user_data.snap.journal"
+USER_DATA_FILE = f"user_data{SHARD_SUFFIX}.json"
+USER_DATA_JOURNAL_FILE = f"user_data{SHARD_SUFFIX}.journal"
+USER_DATA_DB_FILE = f"user_data{SHARD_SUFFIX}.db"
+USER_DATA_SNAPSHOT_FILE = f"user_data{SHARD_SUFFIX}.snap"
+USER_DATA_SNAPSHOT_JOURNAL_FILE = f"user_data{SHARD_SUFFIX}.snap.journal"
+JOURNAL_COMPACT_THRESHOLD = 500
+# По умолчанию ленивый снимок: json держит в памяти всех пользователей, и MAX_RESIDENT_USERS его не ограничивает
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "snapshot").lower()
+PERSIST_DEBOUNCE = float(os.getenv("PERSIST_DEBOUNCE", "0.2"))
+PERSIST_MAX_DELAY = float(os.getenv("PERSIST_MAX_DELAY", "1.0"))
+QR_RENDER_WORKERS = int(os.getenv("QR_RENDER_WORKERS", "2"))
+QR_RENDER_POOL = os.getenv("QR_RENDER_POOL", "thread").lower()
+QR_MEMORY_CACHE_SIZE = int(os.getenv("QR_MEMORY_CACHE_SIZE", "128"))
+QR_DISK_CACHE_SIZE = int(os.getenv("QR_DISK_CACHE_SIZE", "5000"))
+QR_PAGE_SIZE = max(1, int(os.getenv("QR_PAGE_SIZE", "10")))
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "600"))
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "0").lower() in ("1", "true", "yes")
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9101"))
+
+user_locks = UserLockRegistry()
+send_scheduler = SendScheduler(SEND_GLOBAL_RATE, max(1, int(SEND_GLOBAL_RATE)), SEND_CHAT_RATE, SEND_CHAT_BURST,
+                               SEND_MAX_RETRIES, log=log_message)
+metrics = MetricsRegistry(METRICS_ENABLED)
+metrics_runner = None
+storage_warmup = None
+storage_failure = None
+app_task = None
+profiler_session = None
+profiler_middleware = None
+profiler_timer = None
+profiler_message = None
+qr_renderer = QrRenderer(QR_RENDER_WORKERS, QR_RENDER_POOL)
+qr_renderer.render = metrics.timed("counter_bot_qr_render_seconds", "Отрисовка PNG QR-кода при промахе кэша")(qr_renderer.render)
+parse_message = metrics.timed("counter_bot_parse_message_seconds", "Разбор строк входящего сообщения")(parse_message)
+qr_cache = QrCache(qr_renderer, QR_CODE_DIR, QR_MEMORY_CACHE_SIZE, QR_DISK_CACHE_SIZE)
+
+configure_logging(LOG_LEVEL, LOG_DIR, LOG_FLUSH_INTERVAL, LOG_MAX_BYTES, LOG_ROTATE_HOURS * 3600, LOG_BACKUP_COUNT)
+
+def create_json_storage():
+    return JsonStorage(USER_DATA_FILE, USER_DATA_JOURNAL_FILE, JOURNAL_COMPACT_THRESHOLD, log=log_message)
+
+def create_storage():
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteStorage(USER_DATA_DB_FILE, log=log_message)
+    if STORAGE_BACKEND == "json":
+        return create_json_storage()
+    if STORAGE_BACKEND != "snapshot":
+        log_message("WARNING", action="Конфигурация", details=f"Неизвестный STORAGE_BACKEND={STORAGE_BACKEND}, используется snapshot")
+    return SnapshotStorage(USER_DATA_SNAPSHOT_FILE, USER_DATA_SNAPSHOT_JOURNAL_FILE, JOURNAL_COMPACT_THRESHOLD, log=log_message)
+
+def iter_shared_users():
+    if STORAGE_BACKEND == "sqlite" and os.path.exists(SHARED_USER_DATA_DB_FILE):
+        source = SqliteStorage(SHARED_USER_DATA_DB_FILE, log=log_message)
+        source.open()
         try:
-            if os.path.exists(USER_DATA_FILE):
-                with open(USER_DATA_FILE, "r", encoding="utf-8") as f:
-                    data_from_file = json.load(f)
-                    user_data = {int(k): v for k, v in data_from_file.items()}
-                    for uid in user_data:
-                        if 'qr_codes' not in user_data[uid]:
-                            user_data[uid]['qr_codes'] = {'next_qr_id': 1, 'codes': []}
-                        if 'next_qr_id' not in user_data[uid]['qr_codes']: 
-                             user_data[uid]['qr_codes']['next_qr_id'] = 1
-                        if 'codes' not in user_data[uid]['qr_codes']:
-                             user_data[uid]['qr_codes']['codes'] = []
-                        user_data[uid].setdefault('last_additions', [])
-
-                    log_message("SYSTEM", action="Загрузка данных", details=f"Данные пользователей загружены из {USER_DATA_FILE}")
-            else:
-                user_data = {}
-                log_message("SYSTEM", action="Загрузка данных", details=f"Файл {USER_DATA_FILE} не найден, используется пустая база.")
-        except (json.JSONDecodeError, IOError) as e:
-            user_data = {}
-            log_message("ERROR", action="Загрузка данных", details=f"Ошибка загрузки {USER_DATA_FILE}: {e}. Используется пустая база.")
-
-def save_all_user_data():
-    global user_data
-    with data_lock:
+            yield from source.iter_users()
+        finally:
+            source.close()
+    elif STORAGE_BACKEND == "snapshot" and os.path.exists(SHARED_USER_DATA_SNAPSHOT_FILE):
+        users = SnapshotStorage(SHARED_USER_DATA_SNAPSHOT_FILE, SHARED_USER_DATA_SNAPSHOT_JOURNAL_FILE, log=log_message).read()
         try:
-            data_to_save = {str(k): v for k, v in user_data.items()}
-            log_message("SYSTEM", action="Сохранение данных", details=f"Начало записи в временный файл {USER_DATA_TEMP_FILE}")
-            with open(USER_DATA_TEMP_FILE, "w", encoding="utf-8") as f:
-                json.dump(data_to_save, f, ensure_ascii=False, indent=4)
-            log_message("SYSTEM", action="Сохранение данных", details=f"Временный файл {USER_DATA_TEMP_FILE} успешно записан.")
-            
-            log_message("SYSTEM", action="Сохранение данных", details=f"Замена основного файла {USER_DATA_FILE} временным файлом.")
-            os.replace(USER_DATA_TEMP_FILE, USER_DATA_FILE)
-            log_message("SYSTEM", action="Сохранение данных", details=f"Основной файл {USER_DATA_FILE} успешно обновлен.")
-        except IOError as e:
-            log_message("ERROR", action="Сохранение данных", details=f"Ошибка сохранения в {USER_DATA_FILE}: {e}")
+            yield from users.all_items()
+        finally:
+            users.close()
+    elif os.path.exists(SHARED_USER_DATA_FILE):
+        yield from JsonStorage(SHARED_USER_DATA_FILE, SHARED_USER_DATA_JOURNAL_FILE, log=log_message).read().items()
+
+def load_all_user_data():
+    global storage, persistence, user_data
+    storage = create_storage()
+    storage.open()
+    storage.apply_batch = metrics.timed("counter_bot_storage_write_seconds", "Запись пачки изменений в хранилище")(storage.apply_batch)
+    if isinstance(storage, SqliteStorage) and storage.is_empty() and os.path.exists(USER_DATA_FILE):
+        migrated = migrate_json_to_sqlite(create_json_storage(), storage)
+        log_message("SYSTEM", action="Миграция данных", details=f"Перенесено пользователей из {USER_DATA_FILE} в {USER_DATA_DB_FILE}: {migrated}")
+    elif isinstance(storage, SnapshotStorage) and storage.is_empty() and os.path.exists(USER_DATA_FILE):
+        migrated = migrate_json_to_snapshot(create_json_storage(), storage)
+        log_message("SYSTEM", action="Миграция данных", details=f"Перенесено пользователей из {USER_DATA_FILE} в {USER_DATA_SNAPSHOT_FILE}: {migrated}")
+    if SHARD_COUNT > 1 and storage.is_empty():
+        migrated = migrate_to_shard(iter_shared_users(), storage, SHARD_ID, SHARD_COUNT)
+        if migrated:
+            log_message("SYSTEM", action="Миграция данных", details=f"Шард {SHARD_ID} из {SHARD_COUNT}: перенесено пользователей из общей базы: {migrated}")
+    user_data = OrderedDict()
+    persistence = PersistenceWorker(storage, PERSIST_DEBOUNCE, PERSIST_MAX_DELAY, log=log_message)
+    log_message("SYSTEM", action="Хранилище", details=f"Используется хранилище: {storage.name}")
+
+def record_change(entry):
+    if persistence:
+        persistence.mark_dirty(entry['user'], entry)
+        return
+    try:
+        storage.apply(entry)
+    except Exception as e:
+        log_message("ERROR", entry.get('user'), action="Сохранение данных", details=f"Ошибка записи изменения {entry['op']}: {e}")
+
+def get_user_data(user_id):
+    state = user_data.get(user_id)
+    if state is not None:
+        user_data.move_to_end(user_id)
+    elif storage:
+        user_entry = storage.load_user(user_id)
+        if user_entry is not None:
+            state = user_data[user_id] = UserState.from_dict(user_entry, UNDO_DEPTH)
+    if len(user_data) > MAX_RESIDENT_USERS:
+        evict_idle_users()
+    return state
+
+async def preload_user(handler, event, data):
+    # Промах кэша читается из хранилища в потоке: storage.lock может быть занят сжатием,
+    # и цикл событий не должен его ждать. Обработчик затем находит пользователя уже в памяти
+    user = data.get("event_from_user")
+    if user is not None and storage is not None and user.id not in user_data:
+        user_entry = await asyncio.to_thread(storage.load_user, user.id)
+        if user_entry is not None and user.id not in user_data:
+            user_data[user.id] = UserState.from_dict(user_entry, UNDO_DEPTH)
+            if len(user_data) > MAX_RESIDENT_USERS:
+                evict_idle_users()
+    return await handler(event, data)
 
 def get_or_init_user_data(user_id, username=None):
-    is_new_user = user_id not in user_data
-    user_entry = user_data.setdefault(user_id, {
-        'count': 0,
-        'values': {},
-        'last_additions': []
-    })
-
-    if is_new_user:
+    state = get_user_data(user_id)
+    if state is None:
+        state = user_data[user_id] = UserState(history_depth=UNDO_DEPTH)
+        if len(user_data) > MAX_RESIDENT_USERS:
+            evict_idle_users()
         log_message("INFO", user_id, username, action="Создан новый пользователь",
                    details="Инициализированы данные, включая раздел QR")
-    elif 'qr_codes' not in user_entry:
-        log_message("INFO", user_id, username, action="Обновление пользователя",
-                   details="Добавлен раздел QR для существующего пользователя")
-
-    ensure_qr_structure(user_entry)
-    return user_entry
-
-def ensure_qr_structure(user_data_entry):
-    qr_data = user_data_entry.setdefault('qr_codes', {'next_qr_id': 1, 'codes': []})
-    qr_data.setdefault('next_qr_id', 1)
-    qr_data.setdefault('codes', [])
+        record_change({'op': 'init', 'user': user_id})
+    return state
+
+def evict_idle_users():
+    excess = len(user_data) - MAX_RESIDENT_USERS
+    # Пользователей с несохраненными изменениями или активным обработчиком не выгружаем:
+    # они станут чистыми после ближайшей записи и уйдут при следующем вытеснении
+    victims = []
+    for user_id in user_data:
+        if len(victims) == excess:
+            break
+        if user_id in user_locks.holders or (persistence and persistence.is_dirty(user_id)):
+            continue
+        victims.append(user_id)
+
+    for user_id in victims:
+        unload_user(user_id)
+    if log_enabled("DEBUG") and victims:
+        log_message("DEBUG", action="Вытеснение пользователей", details=f"Выгружено: {len(victims)}, в памяти: {len(user_data)}")
+
+def unload_user(user_id):
+    user_data.pop(user_id, None)
+    category_indexes.pop(user_id, None)
+    qr_repositories.pop(user_id, None)
+    qr_page_markups.pop(user_id, None)
+
+async def send_reply(message, text, **kwargs):
+    return await send_scheduler.send(message.chat.id, lambda: message.reply(text, **kwargs))
+
+async def send_long_reply(message, text, reply_markup=None):
+    # Длинные итоги уходят несколькими сообщениями, клавиатура прикрепляется к последнему
+    chunks = list(split_message(text))
+    for chunk in chunks[:-1]:
+        await send_reply(message, chunk)
+    return await send_reply(message, chunks[-1], reply_markup=reply_markup)
+
+async def send_reply_photo(message, **kwargs):
+    return await send_scheduler.send(message.chat.id, lambda: message.reply_photo(**kwargs), PRIORITY_PHOTO)
+
+async def send_reply_document(message, **kwargs):
+    return await send_scheduler.send(message.chat.id, lambda: message.reply_document(**kwargs), PRIORITY_PHOTO)
+
+async def send_edit_text(message, text, **kwargs):
+    return await send_scheduler.send(message.chat.id, lambda: message.edit_text(text, **kwargs))
+
+async def send_edit_markup(message, **kwargs):
+    return await send_scheduler.send(message.chat.id, lambda: message.edit_reply_markup(**kwargs))
+
+async def send_qr_photo(message, qr_text, caption, user_id=None, username=None):
+    cache_key = qr_cache_key(qr_text)
+    file_id = qr_cache.get_file_id(cache_key)
+    if file_id:
+        try:
+            return await send_reply_photo(message, photo=file_id, caption=caption, reply_markup=QR_KEYBOARD)
+        except TelegramBadRequest as e:
+            log_message("WARNING", user_id, username, action="Кэш QR", details=f"file_id отклонен Telegram, повторная загрузка: {e}")
+            qr_cache.forget_file_id(cache_key)
+
+    png_data = await qr_cache.get_png(qr_text)
+    qr_image_file = BufferedInputFile(png_data, filename=f"qr_{cache_key[:16]}.png")
+    sent_message = await send_reply_photo(message, photo=qr_image_file, caption=caption, reply_markup=QR_KEYBOARD)
+    if sent_message is not None and sent_message.photo:
+        qr_cache.remember_file_id(cache_key, sent_message.photo[-1].file_id)
+    return sent_message
+
+def get_qr_repository(user_id):
+    state = get_user_data(user_id)
+    if state is None:
+        return None
+    repository = qr_repositories.get(user_id)
+    if repository is None or repository.state is not state:
+        repository = qr_repositories[user_id] = QrRepository(state)
+    return repository
+
+def get_user_qr_codes(user_id):
+    repository = get_qr_repository(user_id)
+    return repository.records() if repository else []
 
 def log_user_state(user_id):
+    if not log_enabled("DEBUG"):
+        return
+
     if user_id not in user_data:
         log_message("DEBUG", user_id, action="Состояние пользователя", details="Данные отсутствуют")
         return
     
     state = user_data[user_id]
-    count = state.get('count', 0)
-    values = state.get('values', {})
+    count = state.count
+    values = state.values
     
     log_message("DEBUG", user_id, action="Состояние", 
                details=f"Сообщений: {count}, Категорий: {len(values)}")
@@ -179,54 +302,95 @@ def log_user_state(user_id):
         values_str = ", ".join([f"{k}={v}" for k, v in values.items()])
         log_message("DEBUG", user_id, action="Значения", details=values_str)
 
-load_dotenv()
-
-bot = Bot(token=os.getenv("BOT_TOKEN"))
-dp = Dispatcher()
-
-user_data = {}
-
-def get_keyboard():
-    buttons = [
-        [KeyboardButton(text="📝 Новый подсчет")],
-        [KeyboardButton(text="🔄 Очистить")],
-        [KeyboardButton(text="❓ Инструкция")],
-        [KeyboardButton(text="🖼️ QR Коды")]
+# Bot и Dispatcher создает create_app() уже после проверки токена; обработчики живут в router
+bot = None
+dp = None
+router = Router()
+startup_timer = StartupTimer(STARTED_AT)
+
+user_data = OrderedDict()
+category_indexes = {}
+qr_repositories = {}
+qr_page_markups = {}
+pending_messages = {}
+storage = None
+persistence = None
+
+MAIN_KEYBOARD = ReplyKeyboardMarkup(keyboard=[
+    [KeyboardButton(text="📝 Новый подсчет")],
+    [KeyboardButton(text="🔄 Очистить")],
+    [KeyboardButton(text="❓ Инструкция")],
+    [KeyboardButton(text="🖼️ QR Коды")],
+    [KeyboardButton(text="📤 Экспорт")]
+], resize_keyboard=True)
+
+QR_KEYBOARD = ReplyKeyboardMarkup(keyboard=[
+    [KeyboardButton(text="➕ Создать QR")],
+    [KeyboardButton(text="📋 Список QR")],
+    [KeyboardButton(text="🗑️ Удалить QR")],
+    [KeyboardButton(text="⬅️ Назад")]
+], resize_keyboard=True)
+
+# mode -> (префикс кнопки, префикс callback_data для выбранного QR)
+QR_PAGE_MODES = {
+    'list': ("QR: ", "show_qr_"),
+    'delete': ("Удалить: ", "delete_qr_"),
+}
+
+def shorten_text(text, limit):
+    return text[:limit] + "..." if len(text) > limit else text
+
+def build_qr_page_markup(user_id, mode, page):
+    qr_repository = get_qr_repository(user_id)
+    if not qr_repository:
+        return None
+    page_count = (len(qr_repository) + QR_PAGE_SIZE - 1) // QR_PAGE_SIZE
+    page = min(max(page, 0), page_count - 1)
+
+    user_markups = qr_page_markups.setdefault(user_id, {})
+    cached = user_markups.get((mode, page))
+    if cached is not None and cached[0] == qr_repository.version:
+        return cached[1]
+
+    button_prefix, callback_prefix = QR_PAGE_MODES[mode]
+    inline_buttons = [
+        [InlineKeyboardButton(text=button_prefix + shorten_text(qr_item.text, 20), callback_data=f"{callback_prefix}{qr_item.id}")]
+        for qr_item in qr_repository.page(page, QR_PAGE_SIZE)
     ]
-    keyboard = ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
-    return keyboard
-
-def get_qr_keyboard():
-    buttons = [
-        [KeyboardButton(text="➕ Создать QR")],
-        [KeyboardButton(text="📋 Список QR")],
-        [KeyboardButton(text="🗑️ Удалить QR")],
-        [KeyboardButton(text="⬅️ Назад")]
-    ]
-    keyboard = ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
-    return keyboard
-
-@dp.message(Command("start"))
+    if page_count > 1:
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton(text="⬅️", callback_data=f"qr_page_{mode}_{page - 1}"))
+        navigation.append(InlineKeyboardButton(text=f"{page + 1}/{page_count}", callback_data="qr_page_noop"))
+        if page < page_count - 1:
+            navigation.append(InlineKeyboardButton(text="➡️", callback_data=f"qr_page_{mode}_{page + 1}"))
+        inline_buttons.append(navigation)
+
+    markup = InlineKeyboardMarkup(inline_keyboard=inline_buttons)
+    user_markups[(mode, page)] = (qr_repository.version, markup)
+    return markup
+
+@router.message(Command("start"))
 async def send_welcome(message: types.Message):
     user_id = message.from_user.id
     username = message.from_user.username or message.from_user.first_name
     
-    with data_lock:
+    async with user_locks.acquire(user_id):
         get_or_init_user_data(user_id, username)
-        save_all_user_data()
 
     log_message("COMMAND", user_id, username, action="Выполнена команда /start")
     
-    await message.reply(
+    await send_reply(message,
         "Привет! Я бот для помощи в подсчете сумм и QR-кодов. Используйте кнопки ниже для управления:\n\n"
         "📝 Новый подсчет - начать новый цикл подсчета\n"
         "🔄 Очистить - удалить последнее сообщение и вычесть его значения из общей суммы\n\n"
         "🖼️ QR Коды - перейти в раздел управления QR-кодами.\n\n"
+        "📤 Экспорт - выгрузить итоги в CSV\n\n"
         "Отправляйте мне сообщения в формате:\nНазвание - число",
-        reply_markup=get_keyboard()
+        reply_markup=MAIN_KEYBOARD
     )
 
-@dp.message(F.text == "🔄 Очистить")
+@router.message(F.text == "🔄 Очистить")
 async def clear_command(message: types.Message):
     try:
         user_id = message.from_user.id
@@ -236,19 +400,19 @@ async def clear_command(message: types.Message):
         
         reply_text = None
         
-        with data_lock:
-            if user_id in user_data:
-                if user_data[user_id].get('last_additions'):
-                    user_data[user_id]['count'] -= 1
+        async with user_locks.acquire(user_id):
+            flushed = flush_pending_messages(user_id, username)
+            state = get_user_data(user_id)
+            if state is not None:
+                if state.history:
+                    state.count -= 1
                     
-                    last_additions = user_data[user_id].pop('last_additions', [])
+                    last_additions = state.history.pop()
                     removed_values = []
 
-                    for addition in last_additions:
-                        name = addition['name']
-                        value = addition['value']
-                        if name in user_data[user_id]['values']:
-                            user_data[user_id]['values'][name] -= value
+                    for name, value in last_additions:
+                        if name in state.values:
+                            state.values[name] -= value
                             removed_values.append(f"{name}: {value}")
                         else:
                             log_message("WARNING", user_id, username, action="Пропуск вычитания", 
@@ -257,21 +421,18 @@ async def clear_command(message: types.Message):
                     log_message("INFO", user_id, username, action="Отменено последнее добавление", 
                                details=f"Удалены значения: {', '.join(removed_values) if removed_values else 'нет'}")
                     
-                    msg_count = user_data[user_id]['count']
+                    msg_count = state.count
                     if msg_count == 0:
-                        user_data[user_id]['values'] = {}
+                        state.values = {}
+                    state.rendered_totals = None
 
                     log_user_state(user_id)
-                    save_all_user_data() 
+                    record_change({'op': 'undo', 'user': user_id})
                     
                     if msg_count == 0:
                         reply_text = "Последнее сообщение удалено. История пуста. Начните новый подсчет."
                     else:
-                        progress_bar = create_progress_bar(msg_count, MAX_MESSAGES)
-                        response = f"{progress_bar} ({msg_count}/{MAX_MESSAGES})\n\n"
-                        for name, value in user_data[user_id]['values'].items():
-                            response += f"{name} - {value}\n"
-                        reply_text = response
+                        reply_text = format_counter_response(state)
                 else:
                     log_message("INFO", user_id, username, action="Попытка удаления", 
                                details="Нет данных для отмены")
@@ -281,8 +442,9 @@ async def clear_command(message: types.Message):
                            details="Пользователь не найден в базе")
                 reply_text = "История пуста! Нечего удалять."
 
+        await send_flushed_reply(flushed)
         if reply_text:
-            await message.reply(reply_text, reply_markup=get_keyboard())
+            await send_long_reply(message, reply_text, reply_markup=MAIN_KEYBOARD)
     
     except Exception as e:
         log_message("ERROR", user_id, username, action="Ошибка при удалении", 
@@ -290,42 +452,33 @@ async def clear_command(message: types.Message):
         
         print(f"{Colors.RED}Ошибка при очистке данных:{Colors.RESET}\n{traceback.format_exc()}")
         
-        await message.reply("Произошла ошибка при удалении данных. Пожалуйста, попробуйте еще раз.", 
-                           reply_markup=get_keyboard())
+        await send_reply(message, "Произошла ошибка при удалении данных. Пожалуйста, попробуйте еще раз.", 
+                           reply_markup=MAIN_KEYBOARD)
 
-@dp.message(F.text == "📝 Новый подсчет")
+@router.message(F.text == "📝 Новый подсчет")
 async def new_count(message: types.Message):
     user_id = message.from_user.id
     username = message.from_user.username or message.from_user.first_name
     
     log_message("COMMAND", user_id, username, action="Нажата кнопка 'Новый подсчет'")
     
-    with data_lock:
-        current_qr_data = {}
-        if user_id in user_data and 'qr_codes' in user_data[user_id]:
-            current_qr_data = user_data[user_id]['qr_codes']
-
-        user_data[user_id] = {
-            'count': 0,
-            'values': {},
-            'last_additions': [],
-            'qr_codes': current_qr_data
-        }
-        
-        ensure_qr_structure(user_data[user_id])
+    async with user_locks.acquire(user_id):
+        flushed = flush_pending_messages(user_id, username)
+        get_or_init_user_data(user_id, username).reset_cycle()
+        record_change({'op': 'reset', 'user': user_id})
 
         log_message("INFO", user_id, username, action="Начат новый подсчет", 
                    details="Данные пользователя сброшены (кроме QR)")
         
         log_user_state(user_id)
-        save_all_user_data()
     
-    await message.reply(
+    await send_flushed_reply(flushed)
+    await send_reply(message,
         "Начат новый подсчет!\nОтправьте мне данные в формате:\nНазвание - число",
-        reply_markup=get_keyboard()
+        reply_markup=MAIN_KEYBOARD
     )
 
-@dp.message(F.text == "❓ Инструкция")
+@router.message(F.text == "❓ Инструкция")
 async def show_instructions(message: types.Message):
     user_id = message.from_user.id
     username = message.from_user.username or message.from_user.first_name
@@ -338,6 +491,7 @@ async def show_instructions(message: types.Message):
         "📝 Новый подсчет - начать новый цикл подсчета (данные QR-кодов сохраняются).\n\n"
         "🔄 Очистить - удалить последнее сообщение и вычесть его значения из общей суммы.\n\n"
         "🖼️ QR Коды - перейти в раздел управления QR-кодами.\n\n"
+        "📤 Экспорт - получить текущие итоги (и по желанию историю сообщений) файлом CSV для таблиц.\n\n"
         "  В разделе QR Кодов:\n"
         "  ➕ Создать QR - сгенерировать новый QR-код по вашему тексту.\n"
         "  📋 Список QR - показать список созданных QR-кодов и отправить выбранный.\n\n"
@@ -347,78 +501,211 @@ async def show_instructions(message: types.Message):
         "Нулевые значения сохраняются и отображаются для всех категорий.\n\n"
         f"Максимальное количество сообщений в одном цикле - {MAX_MESSAGES}."
     )
-    await message.reply(instructions, reply_markup=get_keyboard())
+    await send_reply(message, instructions, reply_markup=MAIN_KEYBOARD)
+
+@router.message(F.text == "📤 Экспорт")
+async def export_command(message: types.Message):
+    user_id = message.from_user.id
+    username = message.from_user.username or message.from_user.first_name
+
+    log_message("COMMAND", user_id, username, action="Нажата кнопка 'Экспорт'")
+
+    keyboard_inline = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Итоги", callback_data="export_totals")],
+        [InlineKeyboardButton(text="Итоги и история", callback_data="export_history")]
+    ])
+    await send_reply(message, "Что выгрузить в CSV?", reply_markup=keyboard_inline)
+
+@router.callback_query(F.data.in_({"export_totals", "export_history"}))
+async def process_export_callback(callback_query: types.CallbackQuery):
+    user_id = callback_query.from_user.id
+    username = callback_query.from_user.username or callback_query.from_user.first_name
+    with_history = callback_query.data == "export_history"
+
+    # Снимок берется под блокировкой, сам файл собирается уже после нее
+    async with user_locks.acquire(user_id):
+        flushed = flush_pending_messages(user_id, username)
+        state = get_user_data(user_id)
+        values = list(state.values.items()) if state else []
+        history = list(state.history) if state else []
+
+    await send_flushed_reply(flushed)
+    if not values:
+        await callback_query.answer()
+        await send_reply(callback_query.message, "Нет данных для экспорта. Отправьте значения в формате:\nНазвание - число",
+                         reply_markup=MAIN_KEYBOARD)
+        return
+
+    stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    try:
+        await send_reply_document(callback_query.message, reply_markup=MAIN_KEYBOARD,
+                                  document=make_csv_file(TOTALS_HEADER, lambda: iter_totals_rows(values), len(values), f"totals_{stamp}.csv"))
+        if with_history and history:
+            history_rows = sum(len(additions) for additions in history)
+            await send_reply_document(callback_query.message, reply_markup=MAIN_KEYBOARD,
+                                      document=make_csv_file(HISTORY_HEADER, lambda: iter_history_rows(history), history_rows, f"history_{stamp}.csv"))
+        await callback_query.answer()
+        log_message("INFO", user_id, username, action="Экспорт CSV",
+                   details=f"Категорий: {len(values)}, шагов истории: {len(history) if with_history else 0}")
+    except Exception as e:
+        log_message("ERROR", user_id, username, action="Ошибка экспорта CSV", details=str(e))
+        await callback_query.answer("Ошибка")
+        await send_reply(callback_query.message, "Произошла ошибка при выгрузке. Попробуйте еще раз.", reply_markup=MAIN_KEYBOARD)
+
+@router.message(Command("export_all"))
+async def export_all_command(message: types.Message):
+    user_id = message.from_user.id
+    username = message.from_user.username or message.from_user.first_name
+
+    if user_id not in ADMIN_IDS:
+        log_message("WARNING", user_id, username, action="Отказ в команде /export_all", details="Пользователь не администратор")
+        return
+
+    log_message("COMMAND", user_id, username, action="Выполнена команда /export_all")
+    started = time.monotonic()
+    # Выгрузка идет из хранилища, поэтому сначала дописываем туда все накопленные изменения
+    await persistence.flush()
+    stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    export_file = CsvStreamFile(ALL_USERS_HEADER, lambda: iter_all_users_rows(storage.iter_users()), f"all_users_{stamp}.csv")
+    try:
+        await send_reply_document(message, document=export_file, reply_markup=MAIN_KEYBOARD)
+        log_message("INFO", user_id, username, action="Экспорт всех пользователей",
+                   details=f"Готово за {time.monotonic() - started:.2f} с")
+    except Exception as e:
+        log_message("ERROR", user_id, username, action="Ошибка экспорта всех пользователей", details=str(e))
+        await send_reply(message, "Произошла ошибка при выгрузке. Попробуйте еще раз.", reply_markup=MAIN_KEYBOARD)
+
+PROFILE_USAGE = (
+    "Использование: /profile [cprofile|sample] [N[s|u]]\n"
+    "N или Ns - профилировать N секунд, Nu - следующие N обновлений.\n"
+    "/profile stop - остановить досрочно."
+)
+
+def parse_profile_args(args):
+    mode, seconds, updates = "cprofile", None, None
+    for arg in args:
+        arg = arg.lower()
+        if arg in PROFILE_MODES:
+            mode = arg
+        elif arg.isdigit() or (arg[:-1].isdigit() and arg[-1] == "s"):
+            seconds = int(arg.rstrip("s"))
+        elif arg[:-1].isdigit() and arg[-1] == "u":
+            updates = int(arg[:-1])
+        else:
+            return None
+    if seconds is None and updates is None:
+        seconds = PROFILE_DEFAULT_SECONDS
+    return mode, seconds, updates
+
+async def stop_profiling_after(seconds):
+    await asyncio.sleep(seconds)
+    await finish_profiling()
+
+def schedule_profiling_finish():
+    global profiler_timer
+    if profiler_timer and not profiler_timer.done():
+        profiler_timer.cancel()
+    profiler_timer = asyncio.create_task(finish_profiling())
+
+async def finish_profiling():
+    global profiler_session, profiler_middleware, profiler_timer, profiler_message
+    session, message = profiler_session, profiler_message
+    if session is None:
+        return
+    profiler_session = profiler_message = None
+    session.stop()
+    if profiler_middleware:
+        dp.update.outer_middleware.unregister(profiler_middleware)
+        profiler_middleware = None
+    if profiler_timer and profiler_timer is not asyncio.current_task():
+        profiler_timer.cancel()
+    profiler_timer = None
+
+    stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    try:
+        report_paths, summary = await asyncio.to_thread(lambda: (session.write_report(LOG_DIR, stamp), session.summary()))
+    except OSError as e:
+        log_message("ERROR", action="Профилирование", details=f"Не удалось записать отчет: {e}")
+        report_paths, summary = [], session.summary()
+
+    log_message("SYSTEM", action="Профилирование",
+               details=f"Режим {session.mode}, {session.duration:.1f} с, обновлений {session.seen_updates}, отчет: {', '.join(report_paths)}")
+    try:
+        await send_long_reply(message, f"{summary}\n\nОтчет: {', '.join(report_paths) or 'не записан'}", reply_markup=MAIN_KEYBOARD)
+    except Exception as e:
+        log_message("ERROR", action="Профилирование", details=f"Не удалось отправить сводку: {e}")
+
+@router.message(Command("profile"))
+async def profile_command(message: types.Message):
+    global profiler_session, profiler_middleware, profiler_timer, profiler_message
+    user_id = message.from_user.id
+    username = message.from_user.username or message.from_user.first_name
+
+    if user_id not in ADMIN_IDS:
+        log_message("WARNING", user_id, username, action="Отказ в команде /profile", details="Пользователь не администратор")
+        return
+
+    args = message.text.split()[1:]
+    log_message("COMMAND", user_id, username, action="Выполнена команда /profile", details=" ".join(args))
+
+    if args == ["stop"]:
+        if profiler_session is None:
+            await send_reply(message, "Профилирование не запущено.", reply_markup=MAIN_KEYBOARD)
+        else:
+            await finish_profiling()
+        return
+
+    if profiler_session is not None:
+        await send_reply(message, "Профилирование уже идет. Остановить: /profile stop", reply_markup=MAIN_KEYBOARD)
+        return
+
+    parsed = parse_profile_args(args)
+    if parsed is None:
+        await send_reply(message, PROFILE_USAGE, reply_markup=MAIN_KEYBOARD)
+        return
+    mode, seconds, updates = parsed
+    seconds = min(seconds or PROFILE_MAX_SECONDS, PROFILE_MAX_SECONDS)
+
+    session = ProfilerSession(mode, seconds, updates, threading.get_ident())
+    profiler_session, profiler_message = session, message
+    profiler_middleware = UpdateCountMiddleware(session, schedule_profiling_finish)
+    dp.update.outer_middleware.register(profiler_middleware)
+    # Даже при ограничении по обновлениям сессия не длится дольше PROFILE_MAX_SECONDS
+    profiler_timer = asyncio.create_task(stop_profiling_after(seconds))
+    session.start()
+
+    limit = f"{updates} обновлений" if updates is not None else f"{seconds} с"
+    await send_reply(message, f"Профилирование ({mode}) запущено: {limit}. Сводка придет сюда.", reply_markup=MAIN_KEYBOARD)
 
 def create_progress_bar(current, total, length=10):
     filled = int(length * current / total)
     return '█' * filled + '▒' * (length - filled)
 
-def parse_line(line):
-    if ':' in line:
-        parts = line.split(':')
-        separator = ':'
-    elif '-' in line:
-        parts = line.split('-')
-        separator = '-'
-    else:
-        log_message("DEBUG", action="Парсинг строки", 
-                  details=f"Не найден разделитель в строке: {line}")
-        return None, None
-
-    if len(parts) >= 2:
-        original_name = parts[0].strip()
-        name = ' '.join(parts[0].split())
-        
-        if original_name != name:
-            log_message("DEBUG", action="Нормализация имени", 
-                      details=f"'{original_name}' -> '{name}'")
-        
-        value_part = parts[1].strip()
-        
-        try:
-            value = int(value_part)
-            return name, value
-        except ValueError:
-            numbers = re.findall(r'-?\d+', value_part)
-            if numbers:
-                value = int(numbers[-1])
-                log_message("DEBUG", action="Извлечение числа из текста", 
-                          details=f"Из '{value_part}' получено: {value}")
-                return name, value
-            else:
-                log_message("WARNING", action="Парсинг строки", 
-                          details=f"Не удалось извлечь число из: {value_part}")
-    else:
-        log_message("WARNING", action="Парсинг строки", 
-                  details=f"Некорректный формат строки: {line}")
-    
-    return None, None
-
-@dp.message(F.text == "🖼️ QR Коды")
+@router.message(F.text == "🖼️ QR Коды")
 async def qr_codes_section(message: types.Message, state: FSMContext):
     await state.clear()
     user_id = message.from_user.id
     username = message.from_user.username or message.from_user.first_name
     log_message("COMMAND", user_id, username, action="Переход в раздел 'QR Коды'")
-    await message.reply("Вы в разделе QR-кодов. Выберите действие:", reply_markup=get_qr_keyboard())
+    await send_reply(message, "Вы в разделе QR-кодов. Выберите действие:", reply_markup=QR_KEYBOARD)
 
-@dp.message(F.text == "⬅️ Назад")
+@router.message(F.text == "⬅️ Назад")
 async def go_back_to_main_menu(message: types.Message, state: FSMContext):
     await state.clear()
     user_id = message.from_user.id
     username = message.from_user.username or message.from_user.first_name
     log_message("COMMAND", user_id, username, action="Возврат в главное меню из QR")
-    await message.reply("Возврат в главное меню.", reply_markup=get_keyboard())
+    await send_reply(message, "Возврат в главное меню.", reply_markup=MAIN_KEYBOARD)
 
-@dp.message(F.text == "➕ Создать QR")
+@router.message(F.text == "➕ Создать QR")
 async def request_qr_text_handler(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     username = message.from_user.username or message.from_user.first_name
     log_message("COMMAND", user_id, username, action="Нажата кнопка 'Создать QR'")
     await state.set_state(QRStates.waiting_for_qr_text)
-    await message.reply("Введите текст, который вы хотите преобразовать в QR-код:", reply_markup=types.ReplyKeyboardRemove())
+    await send_reply(message, "Введите текст, который вы хотите преобразовать в QR-код:", reply_markup=types.ReplyKeyboardRemove())
 
-@dp.message(QRStates.waiting_for_qr_text)
+@router.message(QRStates.waiting_for_qr_text)
 async def generate_qr_code_handler(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     username = message.from_user.username or message.from_user.first_name
@@ -426,105 +713,67 @@ async def generate_qr_code_handler(message: types.Message, state: FSMContext):
 
     if not qr_text:
         log_message("WARNING", user_id, username, action="Создание QR", details="Пустой текст для QR")
-        await message.reply("Текст для QR-кода не может быть пустым. Попробуйте еще раз.", reply_markup=get_qr_keyboard())
+        await send_reply(message, "Текст для QR-кода не может быть пустым. Попробуйте еще раз.", reply_markup=QR_KEYBOARD)
         await state.clear()
         return
 
     log_message("MESSAGE", user_id, username, action="Получен текст для QR", details=qr_text)
     
-    reply_photo_args = None
+    caption = None
     reply_text_args = None
 
     try:
-        filepath = None
-        filename = None
-        caption = ""
-        
-        with data_lock:
+        async with user_locks.acquire(user_id):
             get_or_init_user_data(user_id, username)
-            existing_qr = None
-            for qr_code_item in user_data[user_id]['qr_codes']['codes']:
-                if qr_code_item['text'] == qr_text:
-                    existing_qr = qr_code_item
-                    break
-            
-            if existing_qr:
-                log_message("INFO", user_id, username, action="Создание QR", details=f"Найден существующий QR с текстом: {qr_text}")
-                filepath = existing_qr['filepath']
-                if not os.path.exists(filepath):
-                    log_message("WARNING", user_id, username, action="Создание QR", details=f"Файл для существующего QR не найден: {filepath}. Попытка регенерации.")
-                    img_regen = qrcode.make(qr_text)
-                    img_regen.save(filepath)
-                    log_message("INFO", user_id, username, action="QR регенерирован для существующей записи", details=f"Файл: {filepath}")
-                
-                caption = f"У вас уже есть QR-код для текста:\n'{qr_text}'"
-            else:
-                qr_id = user_data[user_id]['qr_codes']['next_qr_id']
-                
-                img = qrcode.make(qr_text)
-                
-                filename = f"qr_user{user_id}_id{qr_id}.png"
-                filepath = os.path.join(QR_CODE_DIR, filename)
-                img.save(filepath)
-                log_message("INFO", user_id, username, action="QR-код сохранен в файл", details=f"Путь: {filepath}")
-
-                user_data[user_id]['qr_codes']['codes'].append({'id': qr_id, 'text': qr_text, 'filepath': filepath})
-                user_data[user_id]['qr_codes']['next_qr_id'] += 1
-                save_all_user_data()
-                
-                log_message("INFO", user_id, username, action="QR-код создан и информация сохранена", details=f"ID: {qr_id}, Текст: {qr_text}, Файл: {filepath}")
-                caption = f"Ваш QR-код для текста:\n'{qr_text}'"
-
-        if filepath and caption:
-             try:
-                with open(filepath, "rb") as qr_file_to_send:
-                    qr_image_file = BufferedInputFile(qr_file_to_send.read(), filename=os.path.basename(filepath))
-                    reply_photo_args = {'photo': qr_image_file, 'caption': caption, 'reply_markup': get_qr_keyboard()}
-             except Exception as e_send:
-                log_message("ERROR", user_id, username, action="Отправка существующего QR", details=str(e_send))
-                reply_text_args = {'text': f"У вас уже есть QR-код для текста:\n'{qr_text}'\nНо произошла ошибка при его отправке. Вы можете найти его в списке.", 'reply_markup': get_qr_keyboard()}
-    
+            existing_qr = get_qr_repository(user_id).find_by_text(qr_text)
+
+        if existing_qr:
+            log_message("INFO", user_id, username, action="Создание QR", details=f"Найден существующий QR с текстом: {qr_text}")
+            caption = f"У вас уже есть QR-код для текста:\n'{qr_text}'"
+        else:
+            # Картинку готовим до сохранения записи, чтобы не оставить QR, который не удалось отрисовать
+            if qr_cache.get_file_id(qr_cache_key(qr_text)) is None:
+                await qr_cache.get_png(qr_text)
+
+            async with user_locks.acquire(user_id):
+                qr_repository = get_qr_repository(user_id)
+                existing_qr = qr_repository.find_by_text(qr_text)
+                if existing_qr:
+                    caption = f"У вас уже есть QR-код для текста:\n'{qr_text}'"
+                else:
+                    qr_record = qr_repository.add(qr_text)
+                    record_change({'op': 'qr_add', 'user': user_id, 'qr': qr_record.to_dict()})
+                    caption = f"Ваш QR-код для текста:\n'{qr_text}'"
+                    log_message("INFO", user_id, username, action="QR-код создан и информация сохранена", details=f"ID: {qr_record.id}, Текст: {qr_text}")
+
     except Exception as e:
         log_message("ERROR", user_id, username, action="Ошибка генерации/сохранения QR", details=str(e))
-        reply_text_args = {"text": "Произошла ошибка при создании или сохранении QR-кода. Попробуйте еще раз.", "reply_markup": get_qr_keyboard()}
+        reply_text_args = {"text": "Произошла ошибка при создании или сохранении QR-кода. Попробуйте еще раз.", "reply_markup": QR_KEYBOARD}
 
-    if reply_photo_args:
-        await message.reply_photo(**reply_photo_args)
+    if caption:
+        await send_qr_photo(message, qr_text, caption, user_id, username)
     elif reply_text_args:
-        await message.reply(**reply_text_args)
+        await send_reply(message, **reply_text_args)
     
     await state.clear()
 
-@dp.message(F.text == "🗑️ Удалить QR")
+@router.message(F.text == "🗑️ Удалить QR")
 async def request_delete_qr_handler(message: types.Message):
     user_id = message.from_user.id
     username = message.from_user.username or message.from_user.first_name
     log_message("COMMAND", user_id, username, action="Нажата кнопка 'Удалить QR'")
 
-    if user_id in user_data and user_data[user_id]['qr_codes']['codes']:
-        qr_list = user_data[user_id]['qr_codes']['codes']
-        
-        if not qr_list:
-            await message.reply("У вас нет QR-кодов для удаления.", reply_markup=get_qr_keyboard())
-            return
-
-        inline_buttons = []
-        for qr_item in qr_list:
-            button_text = qr_item['text'][:20] + "..." if len(qr_item['text']) > 20 else qr_item['text']
-            inline_buttons.append([InlineKeyboardButton(text=f"Удалить: {button_text}", callback_data=f"delete_qr_{qr_item['id']}")])
-        
-        if not inline_buttons:
-             await message.reply("Не удалось сформировать список QR-кодов для удаления.", reply_markup=get_qr_keyboard())
-             return
+    async with user_locks.acquire(user_id):
+        keyboard_inline = build_qr_page_markup(user_id, 'delete', 0) if get_user_qr_codes(user_id) else None
 
-        keyboard_inline = InlineKeyboardMarkup(inline_keyboard=inline_buttons)
-        await message.reply("Выберите QR-код для удаления (нажмите для подтверждения):", reply_markup=keyboard_inline)
+    if keyboard_inline:
+        await send_reply(message, "Выберите QR-код для удаления (нажмите для подтверждения):", reply_markup=keyboard_inline)
         
     else:
         log_message("INFO", user_id, username, action="Запрос на удаление QR", details="Список пуст")
-        await message.reply("У вас нет QR-кодов для удаления.", reply_markup=get_qr_keyboard())
+        await send_reply(message, "У вас нет QR-кодов для удаления.", reply_markup=QR_KEYBOARD)
 
-@dp.callback_query(F.data.startswith('delete_qr_'))
+@router.callback_query(F.data.startswith('delete_qr_'))
 async def process_delete_qr_callback(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
     username = callback_query.from_user.username or callback_query.from_user.first_name
@@ -532,38 +781,34 @@ async def process_delete_qr_callback(callback_query: types.CallbackQuery):
 
     log_message("CALLBACK", user_id, username, action="Получен колбэк на удаление QR (шаг 1)", details=f"ID QR: {qr_id_to_delete}")
 
-    qr_to_delete = None
-    with data_lock:
-        if user_id in user_data and 'qr_codes' in user_data[user_id] and 'codes' in user_data[user_id]['qr_codes']:
-            for qr_code in user_data[user_id]['qr_codes']['codes']:
-                if qr_code['id'] == qr_id_to_delete:
-                    qr_to_delete = qr_code
-                    break
+    async with user_locks.acquire(user_id):
+        qr_repository = get_qr_repository(user_id)
+        qr_to_delete = qr_repository.get(qr_id_to_delete) if qr_repository else None
 
     if qr_to_delete:
-        text_preview = qr_to_delete['text'][:30] + "..." if len(qr_to_delete['text']) > 30 else qr_to_delete['text']
+        text_preview = shorten_text(qr_to_delete.text, 30)
         confirm_buttons = [
             [InlineKeyboardButton(text="Да, удалить", callback_data=f"confirm_delete_{qr_id_to_delete}")],
             [InlineKeyboardButton(text="Отмена", callback_data="cancel_delete")]
         ]
         keyboard_confirm = InlineKeyboardMarkup(inline_keyboard=confirm_buttons)
-        await callback_query.message.edit_text(f"Вы уверены, что хотите удалить QR-код с текстом:\n'{text_preview}'?", reply_markup=keyboard_confirm)
+        await send_edit_text(callback_query.message, f"Вы уверены, что хотите удалить QR-код с текстом:\n'{text_preview}'?", reply_markup=keyboard_confirm)
     else:
-        await callback_query.message.edit_text("QR-код не найден или уже удален.", reply_markup=None)
+        await send_edit_text(callback_query.message, "QR-код не найден или уже удален.", reply_markup=None)
         await callback_query.answer("Ошибка: QR-код не найден.")
         log_message("ERROR", user_id, username, action="Удаление QR (шаг 1)", details=f"QR с ID {qr_id_to_delete} не найден")
 
     await callback_query.answer()
 
-@dp.callback_query(F.data == "cancel_delete")
+@router.callback_query(F.data == "cancel_delete")
 async def process_cancel_delete_qr_callback(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
     username = callback_query.from_user.username or callback_query.from_user.first_name
     log_message("CALLBACK", user_id, username, action="Отмена удаления QR")
-    await callback_query.message.edit_text("Удаление отменено.", reply_markup=None)
+    await send_edit_text(callback_query.message, "Удаление отменено.", reply_markup=None)
     await callback_query.answer("Удаление отменено.")
 
-@dp.callback_query(F.data.startswith('confirm_delete_'))
+@router.callback_query(F.data.startswith('confirm_delete_'))
 async def process_confirm_delete_qr_callback(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
     username = callback_query.from_user.username or callback_query.from_user.first_name
@@ -571,34 +816,18 @@ async def process_confirm_delete_qr_callback(callback_query: types.CallbackQuery
     qr_id_to_delete = int(callback_query.data.split('_')[-1])
     log_message("CALLBACK", user_id, username, action="Получен колбэк на подтверждение удаления QR", details=f"ID QR: {qr_id_to_delete}")
 
-    deleted = False
     qr_text_deleted = ""
+    qr_filepath_deleted = None
     edit_text = None
     answer_text = None
 
-    with data_lock:
-        if user_id in user_data and 'qr_codes' in user_data[user_id] and 'codes' in user_data[user_id]['qr_codes']:
-            qr_codes_list = user_data[user_id]['qr_codes']['codes']
-            qr_to_remove_data = None
-            for i, qr_code in enumerate(qr_codes_list):
-                if qr_code['id'] == qr_id_to_delete:
-                    qr_to_remove_data = qr_code
-                    qr_text_deleted = qr_code['text']
-                    if os.path.exists(qr_code['filepath']):
-                        try:
-                            os.remove(qr_code['filepath'])
-                            log_message("INFO", user_id, username, action="Файл QR удален", details=f"Файл: {qr_code['filepath']}")
-                        except OSError as e:
-                            log_message("ERROR", user_id, username, action="Ошибка удаления файла QR", details=f"Файл: {qr_code['filepath']}, Ошибка: {e}")
-                    else:
-                        log_message("WARNING", user_id, username, action="Файл QR для удаления не найден", details=f"Файл: {qr_code['filepath']}")
-                    
-                    del qr_codes_list[i]
-                    deleted = True
-                    break
-        
-        if deleted:
-            save_all_user_data()
+    async with user_locks.acquire(user_id):
+        qr_repository = get_qr_repository(user_id)
+        deleted_qr = qr_repository.remove(qr_id_to_delete) if qr_repository else None
+        if deleted_qr:
+            qr_text_deleted = deleted_qr.text
+            qr_filepath_deleted = deleted_qr.filepath
+            record_change({'op': 'qr_delete', 'user': user_id, 'id': qr_id_to_delete})
             text_preview = qr_text_deleted[:30] + "..." if len(qr_text_deleted) > 30 else qr_text_deleted
             edit_text = f"QR-код для текста:\n'{text_preview}'\nуспешно удален."
             answer_text = "QR-код удален!"
@@ -608,41 +837,67 @@ async def process_confirm_delete_qr_callback(callback_query: types.CallbackQuery
             answer_text = "Ошибка при удалении."
             log_message("ERROR", user_id, username, action="Ошибка удаления QR из данных", details=f"ID: {qr_id_to_delete}, QR не найден в списке пользователя.")
 
-    await callback_query.message.edit_text(edit_text, reply_markup=None)
+    # Общий кэш картинок не трогаем: его чистит LRU. Удаляем только личный файл из старого формата записей
+    if qr_filepath_deleted:
+        try:
+            if await qr_renderer.remove_cached(qr_filepath_deleted):
+                log_message("INFO", user_id, username, action="Файл QR удален", details=f"Файл: {qr_filepath_deleted}")
+            else:
+                log_message("WARNING", user_id, username, action="Файл QR для удаления не найден", details=f"Файл: {qr_filepath_deleted}")
+        except OSError as e:
+            log_message("ERROR", user_id, username, action="Ошибка удаления файла QR", details=f"Файл: {qr_filepath_deleted}, Ошибка: {e}")
+
+    await send_edit_text(callback_query.message, edit_text, reply_markup=None)
     if answer_text:
         await callback_query.answer(answer_text)
 
-@dp.message(F.text == "📋 Список QR")
+@router.message(F.text == "📋 Список QR")
 async def list_qr_codes_handler(message: types.Message):
     user_id = message.from_user.id
     username = message.from_user.username or message.from_user.first_name
     
-    if user_id in user_data and user_data[user_id]['qr_codes']['codes']:
+    async with user_locks.acquire(user_id):
+        keyboard_inline = build_qr_page_markup(user_id, 'list', 0) if get_user_qr_codes(user_id) else None
+
+    if keyboard_inline:
         log_message("COMMAND", user_id, username, action="Запрос списка QR-кодов")
+        await send_reply(message, "Ваши QR-коды (нажмите, чтобы показать):", reply_markup=keyboard_inline)
         
-        qr_list = user_data[user_id]['qr_codes']['codes']
-        
-        if not qr_list:
-            await message.reply("У вас еще нет сохраненных QR-кодов. Создайте новый!", reply_markup=get_qr_keyboard())
-            return
+    else:
+        log_message("INFO", user_id, username, action="Запрос списка QR", details="Список пуст")
+        await send_reply(message, "У вас еще нет сохраненных QR-кодов. Создайте новый!", reply_markup=QR_KEYBOARD)
 
-        inline_buttons = []
-        for qr_item in qr_list:
-            button_text = qr_item['text'][:20] + "..." if len(qr_item['text']) > 20 else qr_item['text']
-            inline_buttons.append([InlineKeyboardButton(text=f"QR: {button_text}", callback_data=f"show_qr_{qr_item['id']}")])
-        
-        if not inline_buttons:
-             await message.reply("Не удалось сформировать список QR-кодов.", reply_markup=get_qr_keyboard())
-             return
+@router.callback_query(F.data.startswith('qr_page_'))
+async def process_qr_page_callback(callback_query: types.CallbackQuery):
+    user_id = callback_query.from_user.id
+    username = callback_query.from_user.username or callback_query.from_user.first_name
 
-        keyboard_inline = InlineKeyboardMarkup(inline_keyboard=inline_buttons)
-        await message.reply("Ваши QR-коды (нажмите, чтобы показать):", reply_markup=keyboard_inline)
-        
+    if callback_query.data == "qr_page_noop":
+        await callback_query.answer()
+        return
+
+    try:
+        _, _, mode, page = callback_query.data.split('_')
+        page = int(page)
+    except ValueError:
+        mode = page = None
+    if mode not in QR_PAGE_MODES:
+        # Поддельные данные или кнопка из старой версии бота
+        log_message("WARNING", user_id, username, action="Переключение страницы QR", details=f"Некорректные данные кнопки: {callback_query.data}")
+        await callback_query.answer("Кнопка устарела, откройте список QR заново.")
+        return
+    log_message("CALLBACK", user_id, username, action="Переключение страницы QR", details=f"Режим: {mode}, страница: {page + 1}")
+
+    async with user_locks.acquire(user_id):
+        keyboard_inline = build_qr_page_markup(user_id, mode, page) if get_user_qr_codes(user_id) else None
+
+    if keyboard_inline:
+        await send_edit_markup(callback_query.message, reply_markup=keyboard_inline)
     else:
-        log_message("INFO", user_id, username, action="Запрос списка QR", details="Список пуст")
-        await message.reply("У вас еще нет сохраненных QR-кодов. Создайте новый!", reply_markup=get_qr_keyboard())
+        await send_edit_text(callback_query.message, "У вас еще нет сохраненных QR-кодов. Создайте новый!", reply_markup=None)
+    await callback_query.answer()
 
-@dp.callback_query(F.data.startswith('show_qr_'))
+@router.callback_query(F.data.startswith('show_qr_'))
 async def process_show_qr_callback(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
     username = callback_query.from_user.username or callback_query.from_user.first_name
@@ -650,167 +905,66 @@ async def process_show_qr_callback(callback_query: types.CallbackQuery):
 
     log_message("CALLBACK", user_id, username, action="Запрос на показ QR", details=f"ID: {qr_id_to_show}")
 
-    qr_code_info = None
-    with data_lock:
-        if user_id in user_data and 'qr_codes' in user_data[user_id]:
-            for qr in user_data[user_id]['qr_codes']['codes']:
-                if qr['id'] == qr_id_to_show:
-                    qr_code_info = qr
-                    break
+    async with user_locks.acquire(user_id):
+        qr_repository = get_qr_repository(user_id)
+        qr_code_info = qr_repository.get(qr_id_to_show) if qr_repository else None
     
-    if qr_code_info and 'filepath' in qr_code_info:
-        filepath = qr_code_info['filepath']
-        text = qr_code_info['text']
+    if qr_code_info:
+        text = qr_code_info.text
+        caption = f"QR-код для текста:\n'{text}'"
         try:
-            if not os.path.exists(filepath):
-                log_message("WARNING", user_id, username, action="Показ QR из списка", details=f"Файл QR не найден: {filepath}. Попытка регенерации.")
-                img = qrcode.make(text)
-                img.save(filepath)
-                log_message("INFO", user_id, username, action="QR регенерирован", details=f"Файл: {filepath}")
-
-            with open(filepath, "rb") as qr_file_to_send:
-                qr_image_file = BufferedInputFile(qr_file_to_send.read(), filename=os.path.basename(filepath))
-                await callback_query.message.reply_photo(
-                    photo=qr_image_file, 
-                    caption=f"QR-код для текста:\n'{text}'",
-                    reply_markup=get_qr_keyboard()
-                )
+            await send_qr_photo(callback_query.message, text, caption, user_id, username)
             await callback_query.answer()
-            log_message("INFO", user_id, username, action="QR-код показан из файла", details=f"ID: {qr_id_to_show}, Файл: {filepath}")
-
-        except FileNotFoundError:
-            log_message("ERROR", user_id, username, action="Ошибка показа QR из списка", details=f"Файл не найден: {filepath}")
-            await callback_query.message.reply("Файл QR-кода не найден. Возможно, он был удален. Попробуйте создать его заново.", reply_markup=get_qr_keyboard())
-            await callback_query.answer("Файл не найден")
+            log_message("INFO", user_id, username, action="QR-код показан", details=f"ID: {qr_id_to_show}, Ключ кэша: {qr_cache_key(text)[:16]}")
         except Exception as e:
             log_message("ERROR", user_id, username, action="Ошибка показа QR из списка", details=str(e))
-            await callback_query.message.reply("Произошла ошибка при отображении QR-кода.", reply_markup=get_qr_keyboard())
-            await callback_query.answer("Ошибка")
-    elif qr_code_info and 'filepath' not in qr_code_info: 
-        log_message("WARNING", user_id, username, action="Показ QR из списка", details=f"Информация о файле для QR с ID {qr_id_to_show} отсутствует. Попытка регенерации на лету.")
-        try:
-            img = qrcode.make(qr_code_info['text'])
-            img_byte_arr = BytesIO()
-            img.save(img_byte_arr, format='PNG')
-            img_byte_arr.seek(0)
-            qr_image_file = BufferedInputFile(img_byte_arr.read(), filename=f"qr_code_{qr_id_to_show}.png")
-            await callback_query.message.reply_photo(
-                photo=qr_image_file, 
-                caption=f"QR-код для текста (сгенерирован на лету):\n'{qr_code_info['text']}'",
-                reply_markup=get_qr_keyboard()
-            )
-            await callback_query.answer()
-        except Exception as e:
-            log_message("ERROR", user_id, username, action="Ошибка регенерации QR на лету", details=str(e))
-            await callback_query.message.reply("Произошла ошибка при отображении QR-кода.", reply_markup=get_qr_keyboard())
+            await send_reply(callback_query.message, "Произошла ошибка при отображении QR-кода.", reply_markup=QR_KEYBOARD)
             await callback_query.answer("Ошибка")
     else:
         log_message("WARNING", user_id, username, action="Показ QR из списка", details=f"QR с ID {qr_id_to_show} не найден")
-        await callback_query.message.reply("QR-код не найден.", reply_markup=get_qr_keyboard())
+        await send_reply(callback_query.message, "QR-код не найден.", reply_markup=QR_KEYBOARD)
         await callback_query.answer("Не найден")
 
-@dp.message()
+# Стикеры, кубики и прочие сообщения без текста в пачку не попадают: разбирать в них нечего
+@router.message(F.text)
 async def process_message(message: types.Message):
     try:
         main_menu_buttons = [
             "📝 Новый подсчет",
             "🔄 Очистить",
             "❓ Инструкция",
-            "🖼️ QR Коды"
+            "🖼️ QR Коды",
+            "📤 Экспорт"
         ]
         if message.text in main_menu_buttons:
             return
 
         user_id = message.from_user.id
         username = message.from_user.username or message.from_user.first_name
+
+        if COALESCE_WINDOW > 0:
+            batch = pending_messages.get(user_id)
+            if batch is not None:
+                batch.append(message)
+                return
+            # Первое сообщение пачки ждет окно и обрабатывает все, что пришло за это время
+            batch = pending_messages[user_id] = [message]
+            try:
+                await asyncio.sleep(COALESCE_WINDOW)
+            finally:
+                # Пачку могла уже применить команда счетчика, пришедшая во время окна
+                flushed = pending_messages.get(user_id) is not batch
+                if not flushed:
+                    del pending_messages[user_id]
+            if flushed:
+                return
+        else:
+            batch = [message]
+
+        async with user_locks.acquire(user_id):
+            response = apply_counter_batch(user_id, username, batch)
         
-        response = None
-        
-        with data_lock:
-            log_message("MESSAGE", user_id, username, action="Получено сообщение", 
-                       details=f"Текст: {message.text}")
-            
-            get_or_init_user_data(user_id, username)
-            
-            if user_data[user_id]['count'] >= MAX_MESSAGES:
-                log_message("INFO", user_id, username, action="Превышен лимит сообщений", 
-                           details="Начат новый цикл")
-                current_qr_data = user_data[user_id].get('qr_codes', {'next_qr_id': 1, 'codes': []})
-                user_data[user_id].update({
-                    'count': 0,
-                    'values': {},
-                    'qr_codes': current_qr_data,
-                    'last_additions': []
-                })
-
-            user_data[user_id]['count'] += 1
-            
-            lines = message.text.split('\n')
-            log_message("DEBUG", user_id, username, action="Разбор сообщения", 
-                       details=f"Количество строк: {len(lines)}")
-            
-            parsed_additions = []
-            for i, line in enumerate(lines):
-                line = line.strip()
-                if not line:
-                    continue
-                
-                log_message("DEBUG", user_id, username, action="Обработка строки", 
-                           details=f"Строка {i+1}: {line}")
-                
-                name, value = parse_line(line)
-                if name and value is not None:
-                    similar_category = find_similar_category(name, user_data[user_id]['values'])
-                    
-                    if similar_category != name:
-                        log_message("DEBUG", user_id, username, action="Похожая категория", 
-                                   details=f"'{name}' похожа на '{similar_category}'")
-                        name = similar_category
-                    
-                    old_value = user_data[user_id]['values'].get(name, 0)
-                    user_data[user_id]['values'][name] = old_value + value
-                    log_message("DEBUG", user_id, username, action="Обновление значения", 
-                               details=f"{name}: {old_value} + {value} = {user_data[user_id]['values'][name]}")
-                    
-                    parsed_additions.append({'name': name, 'value': value})
-                else:
-                    log_message("WARNING", user_id, username, action="Пропуск строки", 
-                               details=f"Не удалось разобрать: {line}")
-            
-            user_data[user_id]['last_additions'] = parsed_additions
-
-            if parsed_additions:
-                log_message("INFO", user_id, username, action="Обработаны значения", 
-                           details=", ".join([f"{item['name']}: {item['value']}" for item in parsed_additions]))
-            else:
-                log_message("WARNING", user_id, username, action="Не удалось обработать сообщение", 
-                           details="Неверный формат")
-            
-            log_user_state(user_id)
-            save_all_user_data()
-
-            msg_count = user_data[user_id]['count']
-            
-            is_final_message = (msg_count == MAX_MESSAGES)
-            
-            response_text = ""
-            if is_final_message:
-                for name, value in user_data[user_id]['values'].items():
-                    response_text += f"{name} - {value}\n"
-                response = response_text
-            else:
-                progress_bar = create_progress_bar(msg_count, MAX_MESSAGES)
-                response_text = f"{progress_bar} ({msg_count}/{MAX_MESSAGES})\n\n"
-                for name, value in user_data[user_id]['values'].items():
-                    response_text += f"{name} - {value}\n"
-                response = response_text
-            
-            if msg_count >= MAX_MESSAGES:
-                log_message("INFO", user_id, username, action="Достигнут или превышен лимит сообщений", 
-                           details=f"{msg_count} из {MAX_MESSAGES}")
-        
-        if response:
-            await message.reply(response, reply_markup=get_keyboard())
+        await send_counter_reply(batch[-1], response)
     
     except Exception as e:
         current_user_id = message.from_user.id if message and message.from_user else None
@@ -821,45 +975,327 @@ async def process_message(message: types.Message):
         tb = traceback.format_exc()
         print(f"{Colors.RED}Ошибка при обработке сообщения:{Colors.RESET}\n{tb}")
         
-        await message.reply("Произошла ошибка при обработке вашего сообщения. Пожалуйста, попробуйте еще раз или начните новый подсчет.", 
-                           reply_markup=get_keyboard())
-
-def string_similarity(s1, s2):
-    return difflib.SequenceMatcher(None, s1, s2).ratio()
+        await send_reply(message, "Произошла ошибка при обработке вашего сообщения. Пожалуйста, попробуйте еще раз или начните новый подсчет.", 
+                           reply_markup=MAIN_KEYBOARD)
+
+def apply_counter_batch(user_id, username, batch):
+    # Вызывается под блокировкой пользователя
+    responses = []
+    state = get_or_init_user_data(user_id, username)
+    for position, batch_message in enumerate(batch, 1):
+        apply_counter_message(state, user_id, username, batch_message.text)
+        # Итоги завершенного цикла не должны потеряться, если следующее сообщение пачки начнет новый
+        if state.count == MAX_MESSAGES or position == len(batch):
+            responses.append(format_counter_response(state))
+
+    if len(batch) > 1:
+        log_message("INFO", user_id, username, action="Объединение сообщений", 
+                   details=f"Обработано сообщений одним ответом: {len(batch)}")
+    return "\n".join(responses)
+
+def flush_pending_messages(user_id, username):
+    # Команды счетчика сначала применяют сообщения, ждущие в окне объединения,
+    # иначе сброс или отмена сработали бы раньше них. Вызывается под блокировкой пользователя
+    batch = pending_messages.pop(user_id, None)
+    if not batch:
+        return None
+    return batch[-1], apply_counter_batch(user_id, username, batch)
+
+async def send_counter_reply(message, response):
+    # Завершенный цикл без категорий дает пустой текст, а пустое сообщение Telegram отклоняет
+    if response:
+        await send_long_reply(message, response, reply_markup=MAIN_KEYBOARD)
+
+async def send_flushed_reply(flushed):
+    if flushed:
+        await send_counter_reply(*flushed)
+
+def apply_counter_message(state, user_id, username, text):
+    log_message("MESSAGE", user_id, username, action="Получено сообщение", 
+               details=f"Текст: {text}")
+
+    # Сначала разбор: если он упадет, счетчик и журнал останутся нетронутыми
+    items, rejected_lines = parse_message(text)
+
+    if state.count >= MAX_MESSAGES:
+        log_message("INFO", user_id, username, action="Превышен лимит сообщений", 
+                   details="Начат новый цикл")
+        state.reset_cycle()
+        record_change({'op': 'reset', 'user': user_id})
+
+    state.count += 1
+    
+    if log_enabled("DEBUG"):
+        log_message("DEBUG", user_id, username, action="Разбор сообщения", 
+                   details=f"Распознано строк: {len(items)}, пропущено: {len(rejected_lines)}")
 
-def remove_trailing_letters(text):
-    return re.sub(r'(\d+[.,]?\d*)[а-яА-Яa-zA-Z]+\b', r'\1', text)
+    for line in rejected_lines:
+        log_message("WARNING", user_id, username, action="Пропуск строки", 
+                   details=f"Не удалось разобрать: {line}")
 
-def normalize_category_name(name):
-    normalized = ' '.join(name.split())
-    normalized = remove_trailing_letters(normalized)
-    return normalized
+    parsed_additions = apply_parsed_items(user_id, items, username)
+    state.history.append(parsed_additions)
+    state.rendered_totals = None
 
-def find_similar_category(name, values, similarity_threshold=SIMILARITY_THRESHOLD):
-    normalized_name = normalize_category_name(name)
-    
-    for existing_name in values.keys():
-        if normalize_category_name(existing_name) == normalized_name:
-            log_message("DEBUG", action="Поиск похожей категории", details=f"Найдено точное совпадение нормализованных имен: '{name}' -> '{existing_name}'")
-            return existing_name
+    if parsed_additions:
+        log_message("INFO", user_id, username, action="Обработаны значения", 
+                   details=", ".join([f"{name}: {value}" for name, value in parsed_additions]))
+    else:
+        log_message("WARNING", user_id, username, action="Не удалось обработать сообщение", 
+                   details="Неверный формат")
     
-    best_match = None
-    highest_similarity = 0.0
-
-    for existing_name in values.keys():
-        similarity = string_similarity(normalized_name, normalize_category_name(existing_name))
-        if similarity >= similarity_threshold and similarity > highest_similarity:
-            highest_similarity = similarity
-            best_match = existing_name
-            
+    record_change({'op': 'add', 'user': user_id,
+                   'items': [list(addition) for addition in parsed_additions], 'depth': UNDO_DEPTH})
+    log_user_state(user_id)
+
+    if state.count >= MAX_MESSAGES:
+        log_message("INFO", user_id, username, action="Достигнут или превышен лимит сообщений", 
+                   details=f"{state.count} из {MAX_MESSAGES}")
+
+def get_totals_text(state):
+    if state.rendered_totals is None:
+        state.rendered_totals = render_totals(state.values)
+    return state.rendered_totals
+
+def format_counter_response(state):
+    msg_count = state.count
+    if msg_count == MAX_MESSAGES:
+        return get_totals_text(state)
+    progress_bar = create_progress_bar(msg_count, MAX_MESSAGES)
+    return f"{progress_bar} ({msg_count}/{MAX_MESSAGES})\n\n{get_totals_text(state)}"
+
+def apply_parsed_items(user_id, items, username=None):
+    values = user_data[user_id].values
+    index = get_category_index(user_id)
+    resolved = {}
+    merged = {}
+
+    for name, value in items:
+        cached = resolved.get(name)
+        if cached is not None and (cached[1] or cached[2] == len(values)):
+            category = cached[0]
+        else:
+            category = intern(find_similar_category(name, values, index=index))
+            if category != name and log_enabled("DEBUG"):
+                log_message("DEBUG", user_id, username, action="Похожая категория", 
+                           details=f"'{name}' похожа на '{category}'")
+            cached = None
+
+        old_value = values.get(category, 0)
+        values[category] = old_value + value
+        merged[category] = merged.get(category, 0) + value
+        if cached is None:
+            is_stable = normalize_category_name(category) == normalize_category_name(name)
+            resolved[name] = (category, is_stable, len(values))
+
+        if log_enabled("DEBUG"):
+            log_message("DEBUG", user_id, username, action="Обновление значения", 
+                       details=f"{category}: {old_value} + {value} = {values[category]}")
+
+    return tuple(Addition(name, value) for name, value in merged.items())
+
+def get_category_index(user_id):
+    index = category_indexes.get(user_id)
+    if index is None:
+        index = category_indexes[user_id] = CategoryIndex()
+    return index
+
+@metrics.timed("counter_bot_find_similar_category_seconds", "Поиск похожей категории")
+def find_similar_category(name, values, similarity_threshold=SIMILARITY_THRESHOLD, index=None):
+    if index is None:
+        index = CategoryIndex()
+    best_match, highest_similarity = index.find(name, values, similarity_threshold)
+
+    if best_match is not None and highest_similarity is None:
+        if log_enabled("DEBUG"):
+            log_message("DEBUG", action="Поиск похожей категории", details=f"Найдено точное совпадение нормализованных имен: '{name}' -> '{best_match}'")
+        return best_match
+
     if best_match:
-        log_message("DEBUG", action="Поиск похожей категории", details=f"Найдена похожая категория: '{name}' -> '{best_match}' с схожестью {highest_similarity:.2f}")
+        if log_enabled("DEBUG"):
+            log_message("DEBUG", action="Поиск похожей категории", details=f"Найдена похожая категория: '{name}' -> '{best_match}' с схожестью {highest_similarity:.2f}")
         return best_match
     
-    log_message("DEBUG", action="Поиск похожей категории", details=f"Похожих категорий для '{name}' не найдено (порог {similarity_threshold}). Создается новая.")
+    if log_enabled("DEBUG"):
+        log_message("DEBUG", action="Поиск похожей категории", details=f"Похожих категорий для '{name}' не найдено (порог {similarity_threshold}). Создается новая.")
     return name
 
+def register_state_metrics():
+    # Считаются при опросе /metrics, на обработку сообщений не влияют
+    metrics.gauge("counter_bot_startup_seconds", "Длительность этапов запуска", ("phase",),
+                  function=lambda: {(phase,): seconds for phase, seconds in startup_timer.phases.items()})
+    metrics.gauge("counter_bot_resident_users", "Пользователи, загруженные в память",
+                  function=lambda: len(user_data))
+    metrics.gauge("counter_bot_resident_categories", "Категории всех пользователей в памяти",
+                  function=lambda: sum(len(state.values) for state in user_data.values()))
+    metrics.gauge("counter_bot_user_categories_max", "Наибольшее число категорий у одного пользователя в памяти",
+                  function=lambda: max((len(state.values) for state in user_data.values()), default=0))
+    metrics.gauge("counter_bot_pending_saves", "Изменения, ожидающие записи в хранилище",
+                  function=lambda: persistence.pending_count if persistence else 0)
+    metrics.gauge("counter_bot_send_queue", "Исходящие сообщения в очереди отправки", ("priority",),
+                  function=lambda: {(priority,): send_scheduler.stats()[f"queued_{priority}"] for priority in ("text", "photo")})
+    for name, help_text in (("sent", "Отправленные запросы к Telegram"),
+                            ("retries", "Повторы после retry_after"),
+                            ("failed", "Запросы к Telegram, завершившиеся ошибкой")):
+        metrics.counter(f"counter_bot_send_{name}_total", help_text,
+                        function=lambda name=name: send_scheduler.stats()[name])
+
+def abort_startup(gate, error):
+    # Без хранилища бот работать не может: останавливаем весь процесс в любом режиме, а не только polling,
+    # чтобы не оставить сервер, который принимает обновления и не обрабатывает их
+    global storage_failure
+    storage_failure = error
+    log_message("ERROR", action="Загрузка данных", details=f"Хранилище не открылось, бот останавливается: {error}")
+    print(f"{Colors.RED}Ошибка загрузки данных:{Colors.RESET}\n{traceback.format_exc()}")
+    dp.update.outer_middleware.unregister(gate)
+    gate.fail()
+    if gate.waited:
+        log_message("WARNING", action="Загрузка данных", details=f"Не обработано обновлений, ждавших загрузки: {gate.waited}")
+    if app_task:
+        app_task.cancel()
+
+async def warm_up_storage(gate):
+    # Хранилище читается в фоне: Telegram уже отдает обновления, а они ждут в gate, пока данные не загрузятся
+    started = time.perf_counter()
+    try:
+        await asyncio.to_thread(load_all_user_data)
+        await asyncio.to_thread(qr_cache.open)
+        persistence.start()
+    except Exception as e:
+        abort_startup(gate, e)
+        return
+    startup_timer.record("load", time.perf_counter() - started)
+    startup_timer.mark("ready")
+    dp.update.outer_middleware.unregister(gate)
+    gate.ready.set()
+    log_message("SYSTEM", action="Время запуска",
+               details=f"{startup_timer.summary()}; обновлений ждали загрузки: {gate.waited}")
+
+async def on_startup(bot: Bot):
+    global metrics_runner, storage_warmup
+    if storage is None:
+        gate = ReadinessGate()
+        dp.update.outer_middleware.register(gate)
+        storage_warmup = asyncio.create_task(warm_up_storage(gate))
+    else:
+        startup_timer.mark("ready")
+
+    if metrics.enabled and metrics_runner is None:
+        register_state_metrics()
+        metrics_runner = await metrics.start_server(METRICS_HOST, METRICS_PORT)
+        log_message("SYSTEM", action="Метрики", details=f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+    log_message("SYSTEM", action="Конфигурация", 
+               details=f"Файл логов: {log_writer.path}, уровень: {LOG_LEVEL}, режим: {BOT_MODE}")
+    log_message("SYSTEM", action="Лимиты", 
+               details=f"Максимум сообщений в цикле: {MAX_MESSAGES}")
+
+    if BOT_MODE == "webhook" and WEBHOOK_URL:
+        await bot.set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None)
+        log_message("SYSTEM", action="Webhook", details=f"Webhook установлен: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+
+async def on_shutdown():
+    global storage, persistence, metrics_runner
+    if storage_warmup and not storage_warmup.done():
+        await asyncio.wait([storage_warmup])
+    await finish_profiling()
+    if persistence:
+        await persistence.stop()
+        persistence = None
+    if storage:
+        storage.close()
+        storage = None
+    await qr_renderer.close()
+    if metrics_runner:
+        await metrics_runner.cleanup()
+        metrics_runner = None
+    log_message("SYSTEM", action="Очередь отправки", details=", ".join(f"{k}={v}" for k, v in send_scheduler.stats().items()))
+
+def create_dispatcher():
+    dispatcher = Dispatcher()
+    dispatcher.message.outer_middleware(preload_user)
+    dispatcher.callback_query.outer_middleware(preload_user)
+    if metrics.enabled:
+        dispatcher.message.middleware(HandlerTimingMiddleware(metrics, "message"))
+        dispatcher.callback_query.middleware(HandlerTimingMiddleware(metrics, "callback_query"))
+    dispatcher.include_router(router)
+    dispatcher.startup.register(on_startup)
+    dispatcher.shutdown.register(on_shutdown)
+    return dispatcher
+
+def create_app(token=None):
+    global bot, dp
+    bot = Bot(token=token or os.getenv("BOT_TOKEN"))
+    dp = create_dispatcher()
+    return bot, dp
+
+def create_webhook_app():
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+    from aiohttp import web
+
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, handle_in_background=True,
+                         secret_token=WEBHOOK_SECRET or None).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+async def run_webhook():
+    from aiohttp import web
+
+    runner = web.AppRunner(create_webhook_app())
+    await runner.setup()
+    try:
+        site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+        await site.start()
+        log_message("SYSTEM", action="Webhook", details=f"Сервер слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+async def process_shard_update(update):
+    try:
+        await dp.feed_raw_update(bot, update)
+    except Exception as e:
+        log_message("ERROR", action="Ошибка обработки обновления", details=f"update_id={update.get('update_id')}: {e}")
+
+async def run_shard(inbox):
+    # Обновления приходят от supervisor.py через очередь; None в очереди - сигнал доработать начатое и выйти
+    loop = asyncio.get_running_loop()
+    reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shard-inbox")
+    global app_task
+    in_flight = set()
+    app_task = asyncio.current_task()
+    create_app()
+    try:
+        await dp.emit_startup(bot=bot)
+        log_message("SYSTEM", action="Шард запущен", details=f"Шард {SHARD_ID} из {SHARD_COUNT}, PID {os.getpid()}")
+        while True:
+            update = await loop.run_in_executor(reader, inbox.get)
+            if update is None:
+                break
+            task = asyncio.create_task(process_shard_update(update))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+        if in_flight:
+            log_message("SYSTEM", action="Остановка шарда", details=f"Дорабатываются обновления: {len(in_flight)}")
+            await asyncio.gather(*in_flight)
+    except asyncio.CancelledError:
+        if storage_failure is None:
+            raise
+    finally:
+        reader.shutdown(wait=False)
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+        log_message("SYSTEM", action="Шард остановлен", details=f"Шард {SHARD_ID} из {SHARD_COUNT}")
+        shutdown_logging()
+    if storage_failure is not None:
+        # Поток чтения очереди висит в inbox.get и не дал бы процессу завершиться; непрочитанные обновления
+        # остаются в очереди, а supervisor перезапустит шард по ненулевому коду выхода
+        os._exit(1)
+
 async def main():
+    global app_task
+    app_task = asyncio.current_task()
     try:
         log_message("SYSTEM", action="Бот запущен", details="Начало работы")
         
@@ -868,23 +1304,29 @@ async def main():
             log_message("ERROR", action="Ошибка конфигурации", details="BOT_TOKEN не найден в переменных окружения. Убедитесь, что вы создали файл .env с BOT_TOKEN=<ВАШ_ТОКЕН>")
             print(f"{Colors.RED}Ошибка: BOT_TOKEN не найден. Пожалуйста, создайте файл .env и добавьте BOT_TOKEN=<ВАШ_ТОКЕН>{Colors.RESET}")
             return
-        
-        load_all_user_data()
 
-        log_message("SYSTEM", action="Конфигурация", 
-                   details=f"Файл логов: {LOG_FILE}")
-        log_message("SYSTEM", action="Лимиты", 
-                   details=f"Максимум сообщений в цикле: {MAX_MESSAGES}")
-        
-        await dp.start_polling(bot)
+        create_app()
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await dp.start_polling(bot)
+    except asyncio.CancelledError:
+        if storage_failure is None:
+            raise
     except Exception as e:
         log_message("ERROR", action="Ошибка в работе бота", details=str(e))
         tb = traceback.format_exc()
         print(f"{Colors.RED}Подробности ошибки:{Colors.RESET}\n{tb}")
     finally:
         log_message("SYSTEM", action="Бот остановлен", details="Завершение работы")
-        save_all_user_data()
-        await bot.session.close()
+        await on_shutdown()
+        if bot:
+            await bot.session.close()
+        shutdown_logging()
+    if storage_failure is not None:
+        raise SystemExit(1)
+
+startup_timer.mark("import")
 
 if __name__ == '__main__':
     print(f"\n{Colors.BOLD}{Colors.GREEN}==== Бот для подсчета сумм ===={Colors.RESET}")
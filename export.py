@@ -0,0 +1,70 @@
+import asyncio
+import csv
+import io
+
+from aiogram.types import BufferedInputFile, InputFile
+
+EXPORT_FLUSH_ROWS = 500
+# До этого числа строк файл собирается в памяти целиком, дальше отдается потоком
+EXPORT_BUFFER_ROWS = 5000
+
+TOTALS_HEADER = ("Категория", "Значение")
+HISTORY_HEADER = ("Шаг", "Категория", "Значение")
+ALL_USERS_HEADER = ("user_id", "Категория", "Значение")
+
+
+def iter_totals_rows(values):
+    for name, value in values:
+        yield name, value
+
+def iter_history_rows(history):
+    for step, additions in enumerate(history, 1):
+        for name, value in additions:
+            yield step, name, value
+
+def iter_all_users_rows(users):
+    for uid, user_entry in users:
+        for name, value in user_entry.get('values', {}).items():
+            yield uid, name, value
+
+def iter_csv_chunks(header, rows, flush_rows=EXPORT_FLUSH_ROWS):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # BOM нужен, чтобы Excel открыл кириллицу в UTF-8 без мастера импорта
+    buffer.write('\ufeff')
+    writer.writerow(header)
+    for row_number, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if row_number % flush_rows == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+def build_csv(header, rows):
+    return b"".join(iter_csv_chunks(header, rows))
+
+
+class CsvStreamFile(InputFile):
+    # Файл собирается по частям прямо во время загрузки и целиком в памяти не лежит.
+    # rows_factory вызывается на каждую попытку отправки, поэтому повтор после retry_after начинает файл заново.
+    def __init__(self, header, rows_factory, filename):
+        super().__init__(filename=filename)
+        self.header = header
+        self.rows_factory = rows_factory
+
+    async def read(self, bot):
+        chunks = iter_csv_chunks(self.header, self.rows_factory())
+        while True:
+            # Строки могут читаться из хранилища, поэтому генератор крутится вне цикла событий
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+
+def make_csv_file(header, rows_factory, row_count, filename):
+    if row_count <= EXPORT_BUFFER_ROWS:
+        return BufferedInputFile(build_csv(header, rows_factory()), filename=filename)
+    return CsvStreamFile(header, rows_factory, filename)
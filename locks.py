@@ -0,0 +1,26 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+
+class UserLockRegistry:
+    def __init__(self):
+        self.locks = {}
+        self.holders = {}
+
+    def __len__(self):
+        return len(self.locks)
+
+    @asynccontextmanager
+    async def acquire(self, user_id):
+        lock = self.locks.get(user_id)
+        if lock is None:
+            lock = self.locks[user_id] = asyncio.Lock()
+        self.holders[user_id] = self.holders.get(user_id, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self.holders[user_id] -= 1
+            if not self.holders[user_id]:
+                del self.holders[user_id]
+                del self.locks[user_id]
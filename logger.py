@@ -0,0 +1,229 @@
+import atexit
+import datetime
+import glob
+import json
+import os
+import queue
+import threading
+import time
+
+
+class Colors:
+    RESET = "\033[0m"
+    BOLD = "\033[1m"
+    UNDERLINE = "\033[4m"
+
+    BLACK = "\033[30m"
+    RED = "\033[31m"
+    GREEN = "\033[32m"
+    YELLOW = "\033[33m"
+    BLUE = "\033[34m"
+    MAGENTA = "\033[35m"
+    CYAN = "\033[36m"
+    WHITE = "\033[37m"
+
+    BG_BLACK = "\033[40m"
+    BG_RED = "\033[41m"
+    BG_GREEN = "\033[42m"
+    BG_YELLOW = "\033[43m"
+    BG_BLUE = "\033[44m"
+    BG_MAGENTA = "\033[45m"
+    BG_CYAN = "\033[46m"
+    BG_WHITE = "\033[47m"
+
+LEVELS = {
+    "DEBUG": 10,
+    "INFO": 20,
+    "MESSAGE": 20,
+    "COMMAND": 20,
+    "CALLBACK": 20,
+    "SYSTEM": 20,
+    "WARNING": 30,
+    "ERROR": 40,
+}
+
+TYPE_COLORS = {
+    "ERROR": Colors.RED,
+    "WARNING": Colors.YELLOW,
+    "COMMAND": Colors.GREEN,
+    "MESSAGE": Colors.CYAN,
+    "INFO": Colors.WHITE,
+    "SYSTEM": Colors.MAGENTA,
+}
+
+
+def new_log_path(log_dir):
+    base = os.path.join(log_dir, f"bot_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}")
+    path = f"{base}.log"
+    suffix = 1
+    while os.path.exists(path):
+        path = f"{base}_{suffix}.log"
+        suffix += 1
+    return path
+
+
+class LogWriter:
+    def __init__(self, log_dir="logs", flush_interval=1.0, batch_size=256,
+                 max_bytes=10 * 1024 * 1024, rotate_seconds=24 * 3600, backup_count=10, console=True):
+        self.log_dir = log_dir
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.backup_count = backup_count
+        self.console = console
+        self.queue = queue.SimpleQueue()
+        self.path = None
+        self.file = None
+        self.opened_at = 0.0
+        self.thread = None
+        self.start_lock = threading.Lock()
+
+    def submit(self, record):
+        if self.thread is None:
+            self.start()
+        self.queue.put(record)
+
+    def start(self):
+        with self.start_lock:
+            if self.thread is None:
+                self._open()
+                self.thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def _open(self):
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.path = new_log_path(self.log_dir)
+        self.file = open(self.path, "a", encoding="utf-8")
+        self.opened_at = time.monotonic()
+        self._cleanup()
+
+    def _cleanup(self):
+        if self.backup_count <= 0:
+            return
+        log_files = sorted(glob.glob(os.path.join(self.log_dir, "bot_*.log")), key=lambda path: (os.path.getmtime(path), path))
+        for old_path in log_files[:-self.backup_count]:
+            if old_path != self.path:
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+
+    def _rotate_if_needed(self):
+        if (self.max_bytes and self.file.tell() >= self.max_bytes) or \
+                (self.rotate_seconds and time.monotonic() - self.opened_at >= self.rotate_seconds):
+            self.file.close()
+            self._open()
+
+    def _run(self):
+        running = True
+        while running:
+            record = self.queue.get()
+            batch = []
+            # Записи копятся до flush_interval от первой из них или до batch_size и пишутся одним сбросом
+            deadline = time.monotonic() + self.flush_interval
+            while record is not None:
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    break
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    record = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+
+            if record is None:
+                running = False
+                while True:
+                    try:
+                        record = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if record is not None:
+                        batch.append(record)
+
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch):
+        console_lines = []
+        file_lines = []
+        for timestamp, message_type, user_id, username, action, details in batch:
+            moment = datetime.datetime.fromtimestamp(timestamp)
+            if self.console:
+                console_lines.append(format_console_line(moment, message_type, user_id, username, action, details))
+            file_lines.append(json.dumps({
+                "time": moment.strftime("%Y-%m-%d %H:%M:%S"),
+                "type": message_type,
+                "user_id": user_id,
+                "username": username,
+                "action": action,
+                "details": details
+            }, ensure_ascii=False) + "\n")
+
+        if console_lines:
+            print("\n".join(console_lines), flush=True)
+        try:
+            self.file.write("".join(file_lines))
+            self.file.flush()
+            self._rotate_if_needed()
+        except (IOError, ValueError) as e:
+            print(f"{Colors.RED}Ошибка записи лога {self.path}: {e}{Colors.RESET}")
+
+
+def format_console_line(moment, message_type, user_id, username, action, details):
+    color_code = TYPE_COLORS.get(message_type, Colors.RESET)
+
+    user_str = f"{user_id}" if user_id else "---"
+
+    username_str = username or "---"
+
+    log_str = f"{moment.strftime('%H:%M:%S')} {color_code}{message_type.ljust(7)}{Colors.RESET}"
+    log_str += f" | {user_str.ljust(10)} | {username_str.ljust(12)}"
+
+    if action:
+        log_str += f" | {action}"
+
+    if details:
+        log_str += f": {details}"
+
+    return log_str
+
+
+log_writer = LogWriter()
+log_threshold = LEVELS["INFO"]
+
+
+def configure_logging(level="INFO", log_dir="logs", flush_interval=1.0, max_bytes=10 * 1024 * 1024,
+                      rotate_seconds=24 * 3600, backup_count=10):
+    global log_threshold
+    log_threshold = LEVELS.get(level.upper(), LEVELS["INFO"])
+    log_writer.log_dir = log_dir
+    log_writer.flush_interval = flush_interval
+    log_writer.max_bytes = max_bytes
+    log_writer.rotate_seconds = rotate_seconds
+    log_writer.backup_count = backup_count
+
+def log_enabled(message_type):
+    return LEVELS.get(message_type, LEVELS["INFO"]) >= log_threshold
+
+def log_message(message_type, user_id=None, username=None, action=None, details=None):
+    if LEVELS.get(message_type, LEVELS["INFO"]) < log_threshold:
+        return
+    log_writer.submit((time.time(), message_type, user_id, username, action, details))
+
+def shutdown_logging():
+    log_writer.stop()
+
+atexit.register(shutdown_logging)
@@ -0,0 +1,95 @@
+import re
+from collections import Counter
+from functools import lru_cache
+from itertools import islice
+
+TRAILING_LETTERS_RE = re.compile(r'(\d+[.,]?\d*)[а-яА-Яa-zA-Z]+\b')
+
+# Запас на погрешность float при сравнении оценок сверху с порогом
+BOUND_EPSILON = 1e-9
+
+
+def string_similarity(s1, s2):
+    import difflib
+    return difflib.SequenceMatcher(None, s1, s2).ratio()
+
+def remove_trailing_letters(text):
+    return TRAILING_LETTERS_RE.sub(r'\1', text)
+
+@lru_cache(maxsize=4096)
+def normalize_category_name(name):
+    normalized = ' '.join(name.split())
+    normalized = remove_trailing_letters(normalized)
+    return normalized
+
+
+class CategoryEntry:
+    __slots__ = ('name', 'normalized', 'length', 'chars', 'matcher')
+
+    def __init__(self, name):
+        self.name = name
+        self.normalized = normalize_category_name(name)
+        self.length = len(self.normalized)
+        self.chars = Counter(self.normalized)
+        self.matcher = None
+
+    def similarity(self, normalized_name):
+        if self.matcher is None:
+            # difflib нужен только при поиске похожих категорий, на запуске его не грузим
+            import difflib
+            self.matcher = difflib.SequenceMatcher(None, '', self.normalized)
+        self.matcher.set_seq1(normalized_name)
+        return self.matcher.ratio()
+
+
+class CategoryIndex:
+    def __init__(self):
+        self.values_ref = None
+        self.entries = []
+        self.exact = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def sync(self, values):
+        if values is not self.values_ref or len(values) < len(self.entries):
+            self.values_ref = values
+            self.entries = []
+            self.exact = {}
+        for name in islice(values, len(self.entries), None):
+            entry = CategoryEntry(name)
+            self.entries.append(entry)
+            self.exact.setdefault(entry.normalized, name)
+
+    def find(self, name, values, similarity_threshold):
+        self.sync(values)
+        normalized_name = normalize_category_name(name)
+
+        exact_match = self.exact.get(normalized_name)
+        if exact_match is not None:
+            return exact_match, None
+
+        length = len(normalized_name)
+        total_chars = None
+        best_match = None
+        highest_similarity = 0.0
+
+        for entry in self.entries:
+            required = max(similarity_threshold, highest_similarity) - BOUND_EPSILON
+            combined = length + entry.length
+            if combined:
+                if 2.0 * min(length, entry.length) / combined < required:
+                    continue
+
+                if total_chars is None:
+                    total_chars = Counter(normalized_name)
+                common = sum(min(count, entry.chars[char]) for char, count in total_chars.items())
+                if 2.0 * common / combined < required:
+                    continue
+
+            similarity = entry.similarity(normalized_name)
+            if similarity >= similarity_threshold and similarity > highest_similarity:
+                highest_similarity = similarity
+                best_match = entry.name
+
+        return best_match, highest_similarity
@@ -0,0 +1,76 @@
+from collections import deque, namedtuple
+from sys import intern
+
+Addition = namedtuple('Addition', ('name', 'value'))
+
+
+class QrRecord:
+    __slots__ = ('id', 'text', 'filepath')
+
+    def __init__(self, qr_id, text, filepath=None):
+        self.id = qr_id
+        self.text = text
+        # Личный файл картинки из старого формата записей, новые записи его не имеют
+        self.filepath = filepath
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['id'], data['text'], data.get('filepath'))
+
+    def to_dict(self):
+        data = {'id': self.id, 'text': self.text}
+        if self.filepath:
+            data['filepath'] = self.filepath
+        return data
+
+
+class UserState:
+    __slots__ = ('count', 'values', 'history', 'next_qr_id', 'qr_codes', 'rendered_totals')
+
+    def __init__(self, count=0, values=None, history=(), next_qr_id=1, qr_codes=None, history_depth=None):
+        self.count = count
+        self.values = {} if values is None else values
+        # Кольцо шагов для отмены: каждый шаг - кортеж Addition одного сообщения
+        self.history = deque(history, maxlen=history_depth)
+        self.next_qr_id = next_qr_id
+        self.qr_codes = [] if qr_codes is None else qr_codes
+        # Готовый текст итогов; сбрасывается при любом изменении values
+        self.rendered_totals = None
+
+    @property
+    def last_additions(self):
+        return self.history[-1] if self.history else ()
+
+    def reset_cycle(self):
+        self.count = 0
+        self.values = {}
+        self.history.clear()
+        self.rendered_totals = None
+
+    @classmethod
+    def from_dict(cls, data, history_depth=None):
+        qr_data = data.get('qr_codes') or {}
+        if 'history' in data:
+            history = data['history']
+        else:
+            last_additions = data.get('last_additions') or []
+            history = [[(item['name'], item['value']) for item in last_additions]] if last_additions else []
+        return cls(
+            count=data.get('count', 0),
+            values={intern(name): value for name, value in data.get('values', {}).items()},
+            history=(tuple(Addition(intern(name), value) for name, value in step) for step in history),
+            next_qr_id=qr_data.get('next_qr_id', 1),
+            qr_codes=[QrRecord.from_dict(qr) for qr in qr_data.get('codes', [])],
+            history_depth=history_depth,
+        )
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'values': dict(self.values),
+            'history': [[list(addition) for addition in step] for step in self.history],
+            'qr_codes': {
+                'next_qr_id': self.next_qr_id,
+                'codes': [qr_record.to_dict() for qr_record in self.qr_codes],
+            },
+        }
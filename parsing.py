@@ -0,0 +1,43 @@
+import re
+
+NUMBER_RE = re.compile(r'-?\d+')
+# Хранилища держат числа в int64 (SQLite, снимок); предел с запасом, чтобы и сумма многих строк в него помещалась
+MAX_VALUE = 10 ** 15
+
+
+def parse_line(line):
+    if ':' in line:
+        separator = ':'
+    elif '-' in line:
+        separator = '-'
+    else:
+        return None, None
+
+    name_part, _, rest = line.partition(separator)
+    name = ' '.join(name_part.split())
+    value_part = rest.split(separator, 1)[0].strip()
+
+    try:
+        value = int(value_part)
+    except ValueError:
+        numbers = NUMBER_RE.findall(value_part)
+        if not numbers:
+            return None, None
+        value = int(numbers[-1])
+    if abs(value) > MAX_VALUE:
+        return None, None
+    return name, value
+
+def parse_message(text):
+    items = []
+    rejected = []
+    for line in text.split('\n'):
+        line = line.strip()
+        if not line:
+            continue
+        name, value = parse_line(line)
+        if name and value is not None:
+            items.append((name, value))
+        else:
+            rejected.append(line)
+    return items, rejected
@@ -0,0 +1,127 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Ошибки в самих данных изменения: повтор записи их не исправит
+DATA_ERRORS = (ValueError, TypeError, KeyError, ArithmeticError)
+
+
+def _no_log(*args, **kwargs):
+    pass
+
+
+class PersistenceWorker:
+    def __init__(self, storage, debounce=0.2, max_delay=1.0, log=None, max_attempts=3):
+        self.storage = storage
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.failed_attempts = 0
+        self.log = log or _no_log
+        self.pending = []
+        self.dirty_users = set()
+        self.flushing_users = set()
+        self.first_pending_at = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persistence")
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.stopping = False
+        self.write_lock = asyncio.Lock()
+
+    @property
+    def pending_count(self):
+        return len(self.pending)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    def is_dirty(self, user_id):
+        return user_id in self.dirty_users or user_id in self.flushing_users
+
+    def mark_dirty(self, user_id, entry):
+        if self.first_pending_at is None:
+            self.first_pending_at = time.monotonic()
+        self.pending.append(entry)
+        self.dirty_users.add(user_id)
+        self.wakeup.set()
+
+    async def _run(self):
+        while not self.stopping:
+            await self.wakeup.wait()
+            if self.stopping:
+                break
+            await self._wait_for_quiet()
+            await self.flush()
+
+    async def _wait_for_quiet(self):
+        deadline = (self.first_pending_at or time.monotonic()) + self.max_delay
+        while not self.stopping:
+            self.wakeup.clear()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=min(self.debounce, remaining))
+            except asyncio.TimeoutError:
+                return
+
+    async def flush(self):
+        async with self.write_lock:
+            self.wakeup.clear()
+            if not self.pending:
+                return
+
+            batch, self.pending = self.pending, []
+            users, self.dirty_users = self.dirty_users, set()
+            self.flushing_users = users
+            self.first_pending_at = None
+
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(self.executor, self.storage.apply_batch, batch)
+                self.failed_attempts = 0
+            except Exception as e:
+                self.failed_attempts += 1
+                if self.failed_attempts >= self.max_attempts:
+                    # Пачка падает раз за разом: записываем по одному изменению и убираем только сломанные,
+                    # иначе к ней бы цеплялись все следующие изменения и ничего больше не сохранялось
+                    self.failed_attempts = 0
+                    batch = await loop.run_in_executor(self.executor, self._apply_separately, batch)
+                    if not batch:
+                        return
+                else:
+                    self.log("ERROR", action="Сохранение данных", details=f"Ошибка фоновой записи {len(batch)} изменений: {e}. Повтор при следующей записи.")
+                self.pending[:0] = batch
+                self.dirty_users |= users
+                if self.first_pending_at is None:
+                    self.first_pending_at = time.monotonic()
+                if not self.stopping:
+                    self.wakeup.set()
+            finally:
+                self.flushing_users = set()
+
+    def _apply_separately(self, batch):
+        # Возвращает изменения, которые стоит повторить: после первой ошибки не в данных
+        # (диск, блокировка базы) остаток пачки не трогаем, чтобы не нарушить порядок изменений
+        for position, entry in enumerate(batch):
+            try:
+                self.storage.apply(entry)
+            except DATA_ERRORS as e:
+                self.log("ERROR", entry.get('user'), action="Сохранение данных",
+                         details=f"Изменение отброшено после {self.max_attempts} неудачных попыток: {entry} ({type(e).__name__}: {e})")
+            except Exception as e:
+                self.log("ERROR", action="Сохранение данных", details=f"Ошибка фоновой записи {len(batch) - position} изменений: {e}. Повтор при следующей записи.")
+                return batch[position:]
+        return []
+
+    async def stop(self):
+        self.stopping = True
+        self.wakeup.set()
+        if self.task:
+            await self.task
+            self.task = None
+        await self.flush()
+        if self.pending:
+            self.log("ERROR", action="Сохранение данных", details=f"Не удалось сохранить изменений при остановке: {len(self.pending)}")
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,154 @@
+import glob
+import io
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from aiogram import BaseMiddleware
+
+PROFILE_MODES = ("cprofile", "sample")
+SAMPLE_INTERVAL = 0.005
+SUMMARY_ROWS = 10
+
+
+def frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class CProfileCollector:
+    def __init__(self):
+        import cProfile
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def write_report(self, path_base):
+        raw_path = path_base + ".prof"
+        text_path = path_base + ".txt"
+        self.profile.dump_stats(raw_path)
+        import pstats
+        stream = io.StringIO()
+        pstats.Stats(self.profile, stream=stream).sort_stats("cumulative").print_stats(100)
+        with open(text_path, "w", encoding="utf-8") as f:
+            f.write(stream.getvalue())
+        return [text_path, raw_path]
+
+    def summary(self):
+        import pstats
+        stats = pstats.Stats(self.profile).stats
+        if not stats:
+            return "Вызовов не записано."
+        total_calls = sum(primitive_calls for primitive_calls, _, _, _, _ in stats.values())
+        # Встроенные обертки вроде run_forever занимают всю верхушку по cumulative, поэтому сортируем по собственному времени
+        rows = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:SUMMARY_ROWS]
+        lines = [f"Вызовов: {total_calls}. Самые затратные функции (собственное / с вложенными, с):"]
+        for (filename, line, name), (_, calls, own_time, cumulative_time, _) in rows:
+            lines.append(f"{own_time:.4f} / {cumulative_time:.4f}  x{calls}  {name} ({os.path.basename(filename)}:{line})")
+        return "\n".join(lines)
+
+
+class StackSampler:
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame.f_code))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def write_report(self, path_base):
+        # Формат collapsed stacks: строка "кадр;кадр;кадр число", его понимают flamegraph.pl и speedscope
+        path = path_base + ".collapsed.txt"
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return [path]
+
+    def summary(self):
+        if not self.samples:
+            return "Снимков стека не получено."
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        lines = [f"Снимков: {self.samples} (раз в {self.interval * 1000:.0f} мс). Где чаще всего находился поток:"]
+        for label, count in leaves.most_common(SUMMARY_ROWS):
+            lines.append(f"{100 * count / self.samples:5.1f}%  {label}")
+        return "\n".join(lines)
+
+
+class ProfilerSession:
+    def __init__(self, mode, seconds=None, updates=None, thread_id=None):
+        self.mode = mode
+        self.seconds = seconds
+        self.updates = updates
+        self.seen_updates = 0
+        self.collector = CProfileCollector() if mode == "cprofile" else StackSampler(thread_id or threading.get_ident())
+        self.started_at = None
+        self.duration = 0.0
+
+    def start(self):
+        self.started_at = time.monotonic()
+        self.collector.start()
+
+    def stop(self):
+        self.collector.stop()
+        self.duration = time.monotonic() - self.started_at
+
+    def count_update(self):
+        self.seen_updates += 1
+        return self.updates is not None and self.seen_updates >= self.updates
+
+    def write_report(self, log_dir, stamp):
+        os.makedirs(log_dir, exist_ok=True)
+        base = path_base = os.path.join(log_dir, f"profile_{stamp}_{self.mode}")
+        suffix = 1
+        while glob.glob(glob.escape(path_base) + ".*"):
+            path_base = f"{base}_{suffix}"
+            suffix += 1
+        return self.collector.write_report(path_base)
+
+    def summary(self):
+        return (f"Профилирование ({self.mode}) завершено: {self.duration:.1f} с, обновлений: {self.seen_updates}.\n\n"
+                f"{self.collector.summary()}")
+
+
+class UpdateCountMiddleware(BaseMiddleware):
+    # Регистрируется только на время профилирования, поэтому в обычной работе ничего не стоит
+    def __init__(self, session, on_limit):
+        self.session = session
+        self.on_limit = on_limit
+
+    async def __call__(self, handler, event, data):
+        try:
+            return await handler(event, data)
+        finally:
+            if self.session.count_update():
+                self.on_limit()
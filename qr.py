@@ -0,0 +1,222 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+
+from logger import log_message
+
+# Параметры отрисовки входят в ключ кэша: при их смене старые картинки не переиспользуются
+RENDER_PARAMS = "qrcode:ec=M;box=10;border=4;png"
+CACHE_FILE_RE = re.compile(r'^[0-9a-f]{64}\.png$')
+
+
+def render_qr_png(text):
+    # qrcode тянет за собой PIL/PyPNG, поэтому грузится при первом рендере, а не при запуске бота
+    import qrcode
+
+    buffer = BytesIO()
+    qrcode.make(text).save(buffer)
+    return buffer.getvalue()
+
+def read_file(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def write_file_atomic(path, data):
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+def remove_file(path):
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+class QrRenderer:
+    def __init__(self, workers=2, pool="thread"):
+        self.workers = workers
+        self.pool = pool
+        self.executor = None
+        self.io_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="qr-io")
+        self.pending_writes = set()
+
+    def _get_executor(self):
+        if self.executor is None:
+            if self.pool == "process":
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="qr-render")
+        return self.executor
+
+    async def render(self, text):
+        return await asyncio.get_running_loop().run_in_executor(self._get_executor(), render_qr_png, text)
+
+    async def load_cached(self, path):
+        return await asyncio.get_running_loop().run_in_executor(self.io_executor, read_file, path)
+
+    def store_cached(self, path, data):
+        task = asyncio.ensure_future(asyncio.get_running_loop().run_in_executor(self.io_executor, write_file_atomic, path, data))
+        self.pending_writes.add(task)
+        task.add_done_callback(lambda done: self._on_write_done(done, path))
+        return task
+
+    def _on_write_done(self, task, path):
+        self.pending_writes.discard(task)
+        if task.cancelled():
+            return
+        if task.exception():
+            log_message("ERROR", action="Кэш QR", details=f"Не удалось записать файл {path}: {task.exception()}")
+
+    async def remove_cached(self, path):
+        return await asyncio.get_running_loop().run_in_executor(self.io_executor, remove_file, path)
+
+    async def close(self):
+        if self.pending_writes:
+            await asyncio.gather(*self.pending_writes, return_exceptions=True)
+        self.io_executor.shutdown(wait=True)
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+
+def qr_cache_key(text):
+    return hashlib.sha256(f"{RENDER_PARAMS}\n{text}".encode("utf-8")).hexdigest()
+
+
+class QrCache:
+    def __init__(self, renderer, cache_dir, memory_items=128, disk_items=5000):
+        self.renderer = renderer
+        self.cache_dir = cache_dir
+        self.memory_items = memory_items
+        self.disk_items = disk_items
+        self.index_path = os.path.join(cache_dir, "file_ids.json")
+        self.memory = OrderedDict()
+        self.disk = OrderedDict()
+        self.file_ids = {}
+        self.rendering = {}
+        self.index_save_pending = False
+
+    def open(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if CACHE_FILE_RE.match(entry.name):
+                entries.append((entry.stat().st_mtime, entry.name[:-4]))
+        self.disk = OrderedDict((key, True) for _, key in sorted(entries))
+
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                self.file_ids = {key: file_id for key, file_id in json.load(f).items() if key in self.disk}
+        except FileNotFoundError:
+            self.file_ids = {}
+        except (json.JSONDecodeError, IOError, AttributeError) as e:
+            self.file_ids = {}
+            log_message("WARNING", action="Кэш QR", details=f"Не удалось прочитать {self.index_path}: {e}")
+
+        if self._pop_evicted():
+            # open() может работать вне цикла событий (прогрев хранилища в потоке), поэтому индекс пишется сразу
+            write_file_atomic(self.index_path, json.dumps(self.file_ids).encode("utf-8"))
+        log_message("SYSTEM", action="Кэш QR", details=f"Файлов в кэше: {len(self.disk)}, file_id: {len(self.file_ids)}")
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, f"{key}.png")
+
+    def get_file_id(self, key):
+        file_id = self.file_ids.get(key)
+        if file_id is not None and key in self.disk:
+            self.disk.move_to_end(key)
+        return file_id
+
+    def remember_file_id(self, key, file_id):
+        if key in self.disk and self.file_ids.get(key) != file_id:
+            self.file_ids[key] = file_id
+            self._schedule_index_save()
+
+    def forget_file_id(self, key):
+        if self.file_ids.pop(key, None) is not None:
+            self._schedule_index_save()
+
+    async def get_png(self, text):
+        key = qr_cache_key(text)
+        png_data = self.memory.get(key)
+        if png_data is not None:
+            self.memory.move_to_end(key)
+            self._touch_disk(key)
+            return png_data
+
+        in_flight = self.rendering.get(key)
+        if in_flight is not None:
+            return await asyncio.shield(in_flight)
+
+        future = asyncio.get_running_loop().create_future()
+        self.rendering[key] = future
+        try:
+            png_data = await self.renderer.load_cached(self.path_for(key)) if key in self.disk else None
+            if png_data is None:
+                png_data = await self.renderer.render(text)
+                self._store_disk(key, png_data)
+            else:
+                self._touch_disk(key)
+            self._store_memory(key, png_data)
+            future.set_result(png_data)
+            return png_data
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            del self.rendering[key]
+
+    def _store_memory(self, key, png_data):
+        self.memory[key] = png_data
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def _touch_disk(self, key):
+        if key in self.disk:
+            self.disk.move_to_end(key)
+
+    def _store_disk(self, key, png_data):
+        self.renderer.store_cached(self.path_for(key), png_data)
+        self.disk[key] = True
+        self.disk.move_to_end(key)
+        self._evict_disk()
+
+    def _evict_disk(self):
+        if self._pop_evicted():
+            self._schedule_index_save()
+
+    def _pop_evicted(self):
+        evicted = False
+        while len(self.disk) > self.disk_items:
+            key, _ = self.disk.popitem(last=False)
+            self.memory.pop(key, None)
+            evicted = self.file_ids.pop(key, None) is not None or evicted
+            self.renderer.io_executor.submit(remove_file, self.path_for(key))
+        return evicted
+
+    def _schedule_index_save(self):
+        if self.index_save_pending:
+            return
+        self.index_save_pending = True
+        asyncio.get_running_loop().call_soon(self._save_index)
+
+    def _save_index(self):
+        self.index_save_pending = False
+        data = json.dumps(self.file_ids).encode("utf-8")
+        self.renderer.store_cached(self.index_path, data)
@@ -0,0 +1,69 @@
+from bisect import bisect_left
+from itertools import count
+from operator import attrgetter
+
+from models import QrRecord
+
+# Общий счетчик версий: у пересозданного репозитория версия не совпадет со старой
+version_counter = count(1)
+
+
+class QrRepository:
+    def __init__(self, state):
+        self.state = state
+        self.by_id = {}
+        self.by_text = {}
+        self.version = 0
+        self.rebuild()
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def rebuild(self):
+        self.by_id = {}
+        self.by_text = {}
+        for qr_record in self.state.qr_codes:
+            self.by_id[qr_record.id] = qr_record
+            self.by_text.setdefault(qr_record.text, qr_record.id)
+        self.version = next(version_counter)
+
+    def get(self, qr_id):
+        return self.by_id.get(qr_id)
+
+    def find_by_text(self, text):
+        qr_id = self.by_text.get(text)
+        return None if qr_id is None else self.by_id[qr_id]
+
+    def records(self):
+        return self.state.qr_codes
+
+    def page(self, page, page_size):
+        start = page * page_size
+        return self.state.qr_codes[start:start + page_size]
+
+    def add(self, text):
+        qr_id = self.state.next_qr_id
+        qr_record = QrRecord(qr_id, text)
+        self.state.qr_codes.append(qr_record)
+        self.state.next_qr_id = qr_id + 1
+        self.by_id[qr_id] = qr_record
+        self.by_text.setdefault(text, qr_id)
+        self.version = next(version_counter)
+        return qr_record
+
+    def remove(self, qr_id):
+        qr_record = self.by_id.pop(qr_id, None)
+        if qr_record is None:
+            return None
+
+        codes = self.state.qr_codes
+        # Id выдаются по возрастанию, поэтому позицию в списке ищем бинарным поиском
+        position = bisect_left(codes, qr_id, key=attrgetter('id'))
+        if position >= len(codes) or codes[position] is not qr_record:
+            position = codes.index(qr_record)
+        del codes[position]
+
+        if self.by_text.get(qr_record.text) == qr_id:
+            del self.by_text[qr_record.text]
+        self.version = next(version_counter)
+        return qr_record
@@ -0,0 +1,28 @@
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+def render_totals(values):
+    return "".join([f"{name} - {value}\n" for name, value in values.items()])
+
+def split_message(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    if len(text) <= limit:
+        yield text
+        return
+
+    chunk = []
+    chunk_length = 0
+    for line in text.splitlines(keepends=True):
+        # Строку длиннее лимита приходится резать посередине
+        while len(line) > limit:
+            if chunk:
+                yield "".join(chunk)
+                chunk, chunk_length = [], 0
+            yield line[:limit]
+            line = line[limit:]
+        if chunk_length + len(line) > limit:
+            yield "".join(chunk)
+            chunk, chunk_length = [], 0
+        chunk.append(line)
+        chunk_length += len(line)
+    if chunk:
+        yield "".join(chunk)
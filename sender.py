@@ -0,0 +1,145 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+from aiogram.exceptions import TelegramRetryAfter
+
+PRIORITY_TEXT = 0
+PRIORITY_PHOTO = 1
+
+CHAT_BUCKETS_PRUNE_AT = 4096
+
+PRIORITY_NAMES = {
+    PRIORITY_TEXT: "text",
+    PRIORITY_PHOTO: "photo",
+}
+
+
+def _no_log(*args, **kwargs):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def reserve(self):
+        # Токен можно взять в долг: вызывающий ждет возвращенную задержку, следующие встают за ним
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(delay, self.paused_until - now)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class SendScheduler:
+    def __init__(self, global_rate=30.0, global_burst=30, chat_rate=1.0, chat_burst=3, max_retries=3, log=None):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.log = log or _no_log
+        self.chat_buckets = {}
+        self.chat_waiters = {}
+        self.prune_at = CHAT_BUCKETS_PRUNE_AT
+        self.waiters = []
+        self.sequence = itertools.count()
+        self.dispatcher = None
+        self.queued = {priority: 0 for priority in PRIORITY_NAMES}
+        self.sent = 0
+        self.retries = 0
+        self.failed = 0
+
+    @property
+    def queue_depth(self):
+        return sum(self.queued.values())
+
+    def stats(self):
+        stats = {f"queued_{name}": self.queued[priority] for priority, name in PRIORITY_NAMES.items()}
+        stats.update(queued=self.queue_depth, sent=self.sent, retries=self.retries, failed=self.failed)
+        return stats
+
+    async def send(self, chat_id, call, priority=PRIORITY_TEXT):
+        self.queued[priority] += 1
+        try:
+            attempt = 0
+            while True:
+                await self._wait_chat(chat_id)
+                await self._wait_global(priority)
+                try:
+                    result = await call()
+                except TelegramRetryAfter as e:
+                    attempt += 1
+                    self.retries += 1
+                    self._chat_bucket(chat_id).pause(e.retry_after)
+                    self.log("WARNING", chat_id, action="Ограничение Telegram",
+                             details=f"retry_after={e.retry_after} с, попытка {attempt} из {self.max_retries}")
+                    if attempt > self.max_retries:
+                        raise
+                    continue
+                self.sent += 1
+                return result
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.queued[priority] -= 1
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _wait_chat(self, chat_id):
+        self.chat_waiters[chat_id] = self.chat_waiters.get(chat_id, 0) + 1
+        try:
+            delay = self._chat_bucket(chat_id).reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        finally:
+            self.chat_waiters[chat_id] -= 1
+            if not self.chat_waiters[chat_id]:
+                del self.chat_waiters[chat_id]
+        if len(self.chat_buckets) > self.prune_at:
+            self._prune_chat_buckets()
+
+    def _prune_chat_buckets(self):
+        # Полностью восстановившийся бакет ничем не отличается от нового, его можно не хранить
+        now = time.monotonic()
+        idle = [chat_id for chat_id, bucket in self.chat_buckets.items()
+                if chat_id not in self.chat_waiters and bucket.paused_until <= now
+                and bucket.tokens + (now - bucket.updated) * bucket.rate >= bucket.burst]
+        for chat_id in idle:
+            del self.chat_buckets[chat_id]
+        self.prune_at = max(CHAT_BUCKETS_PRUNE_AT, 2 * len(self.chat_buckets))
+
+    async def _wait_global(self, priority):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.sequence), future))
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    async def _dispatch(self):
+        # Очередь на глобальный лимит разбирается по приоритету: текст обгоняет загрузку картинок
+        while self.waiters:
+            delay = self.global_bucket.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            while self.waiters:
+                _, _, future = heapq.heappop(self.waiters)
+                if not future.done():
+                    future.set_result(None)
+                    break
+            else:
+                self.global_bucket.tokens += 1
@@ -0,0 +1,263 @@
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+
+# Формат снимка (little-endian):
+#   заголовок  - магия, версия, id снимка и число пользователей;
+#   индекс     - по записи (user_id, смещение, длина) на пользователя, отсортирован по user_id;
+#   записи     - счетчик, категории, история отмены и QR одного пользователя.
+# Строки хранятся как длина (uint32) + UTF-8, отсутствующая строка - длина 0xFFFFFFFF.
+MAGIC = b"CNTS"
+VERSION = 1
+HEADER = struct.Struct("<4sHH16sQ")
+INDEX_ENTRY = struct.Struct("<qQI")
+RECORD_HEADER = struct.Struct("<qqIII")
+INT = struct.Struct("<q")
+LENGTH = struct.Struct("<I")
+NO_STRING = 0xFFFFFFFF
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+def pack_string(parts, text):
+    if text is None:
+        parts.append(LENGTH.pack(NO_STRING))
+        return
+    raw = text.encode("utf-8")
+    parts.append(LENGTH.pack(len(raw)))
+    parts.append(raw)
+
+def read_string(buffer, pos, end):
+    length = LENGTH.unpack_from(buffer, pos)[0]
+    pos += LENGTH.size
+    if length == NO_STRING:
+        return None, pos
+    if pos + length > end:
+        raise SnapshotError(f"Строка выходит за границу записи (смещение {pos})")
+    return str(buffer[pos:pos + length], "utf-8"), pos + length
+
+def encode_record(user_entry):
+    qr_data = user_entry.get('qr_codes') or {}
+    values = user_entry.get('values', {})
+    history = user_entry.get('history', [])
+    codes = qr_data.get('codes', [])
+    parts = [RECORD_HEADER.pack(user_entry.get('count', 0), qr_data.get('next_qr_id', 1), len(values), len(history), len(codes))]
+    for name, value in values.items():
+        pack_string(parts, name)
+        parts.append(INT.pack(value))
+    for step in history:
+        parts.append(LENGTH.pack(len(step)))
+        for name, value in step:
+            pack_string(parts, name)
+            parts.append(INT.pack(value))
+    for qr in codes:
+        parts.append(INT.pack(qr['id']))
+        pack_string(parts, qr['text'])
+        pack_string(parts, qr.get('filepath'))
+    return b"".join(parts)
+
+def decode_record(buffer, offset, length):
+    end = offset + length
+    try:
+        count, next_qr_id, value_count, step_count, qr_count = RECORD_HEADER.unpack_from(buffer, offset)
+        pos = offset + RECORD_HEADER.size
+        values = {}
+        for _ in range(value_count):
+            name, pos = read_string(buffer, pos, end)
+            values[name] = INT.unpack_from(buffer, pos)[0]
+            pos += INT.size
+        history = []
+        for _ in range(step_count):
+            item_count = LENGTH.unpack_from(buffer, pos)[0]
+            pos += LENGTH.size
+            step = []
+            for _ in range(item_count):
+                name, pos = read_string(buffer, pos, end)
+                step.append([name, INT.unpack_from(buffer, pos)[0]])
+                pos += INT.size
+            history.append(step)
+        codes = []
+        for _ in range(qr_count):
+            qr_id = INT.unpack_from(buffer, pos)[0]
+            text, pos = read_string(buffer, pos + INT.size, end)
+            filepath, pos = read_string(buffer, pos, end)
+            qr_record = {'id': qr_id, 'text': text}
+            if filepath is not None:
+                qr_record['filepath'] = filepath
+            codes.append(qr_record)
+    except (struct.error, UnicodeDecodeError) as e:
+        raise SnapshotError(f"Повреждена запись по смещению {offset}: {e}") from e
+    if pos != end:
+        raise SnapshotError(f"Длина записи по смещению {offset} не совпадает с индексом")
+    return {
+        'count': count,
+        'values': values,
+        'history': history,
+        'qr_codes': {'next_qr_id': next_qr_id, 'codes': codes}
+    }
+
+
+def write_snapshot(path, records, count):
+    # records - пары (user_id, запись) по возрастанию user_id; запись - словарь пользователя
+    # или уже закодированные байты из другого снимка, которые копируются без разбора
+    snapshot_id = os.urandom(16)
+    index = []
+    offset = HEADER.size + count * INDEX_ENTRY.size
+    previous_uid = None
+    with open(path, "wb") as f:
+        # Место под заголовок и индекс резервируется сразу, заполняются они после записей
+        f.write(bytes(offset))
+        for uid, record in records:
+            if previous_uid is not None and uid <= previous_uid:
+                raise SnapshotError(f"Пользователи не отсортированы: {uid} после {previous_uid}")
+            previous_uid = uid
+            raw = record if isinstance(record, bytes) else encode_record(record)
+            f.write(raw)
+            index.append(INDEX_ENTRY.pack(uid, offset, len(raw)))
+            offset += len(raw)
+        if len(index) != count:
+            raise SnapshotError(f"Ожидалось пользователей: {count}, записано: {len(index)}")
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, 0, snapshot_id, count))
+        f.write(b"".join(index))
+    return snapshot_id.hex()
+
+
+class SnapshotReader:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        try:
+            self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise SnapshotError(f"Файл {path} пуст")
+        try:
+            magic, version, _, snapshot_id, self.user_count = HEADER.unpack_from(self.buffer, 0)
+            if magic != MAGIC:
+                raise SnapshotError(f"Файл {path} не является снимком")
+            if version != VERSION:
+                raise SnapshotError(f"Неподдерживаемая версия снимка {version} в {path}")
+            self.index_start = HEADER.size
+            self.index_end = self.index_start + self.user_count * INDEX_ENTRY.size
+            if self.index_end > len(self.buffer):
+                raise SnapshotError(f"Индекс снимка {path} обрезан")
+        except struct.error as e:
+            self.close()
+            raise SnapshotError(f"Заголовок снимка {path} обрезан: {e}") from e
+        except SnapshotError:
+            self.close()
+            raise
+        self.snapshot_id = snapshot_id.hex()
+
+    def __len__(self):
+        return self.user_count
+
+    def close(self):
+        self.buffer.close()
+        self.file.close()
+
+    def find(self, user_id):
+        # Двоичный поиск прямо по индексу в mmap: при открытии индекс не разбирается целиком
+        low, high = 0, self.user_count
+        while low < high:
+            middle = (low + high) // 2
+            uid, offset, length = INDEX_ENTRY.unpack_from(self.buffer, self.index_start + middle * INDEX_ENTRY.size)
+            if uid < user_id:
+                low = middle + 1
+            elif uid > user_id:
+                high = middle
+            else:
+                if offset + length > len(self.buffer):
+                    raise SnapshotError(f"Запись пользователя {user_id} выходит за конец файла")
+                return offset, length
+        return None
+
+    def user_ids(self):
+        return [uid for uid, _, _ in INDEX_ENTRY.iter_unpack(self.buffer[self.index_start:self.index_end])]
+
+    def load(self, user_id):
+        location = self.find(user_id)
+        return decode_record(self.buffer, *location) if location else None
+
+    def raw(self, user_id):
+        location = self.find(user_id)
+        if location is None:
+            return None
+        offset, length = location
+        return self.buffer[offset:offset + length]
+
+    def items(self):
+        for uid, offset, length in INDEX_ENTRY.iter_unpack(self.buffer[self.index_start:self.index_end]):
+            yield uid, decode_record(self.buffer, offset, length)
+
+
+def default_journal_path(path):
+    return os.path.splitext(path)[0] + ".journal"
+
+def json_to_snapshot(json_path, snapshot_path, journal_path=None, log=None):
+    # storage сам импортирует этот модуль, поэтому здесь импорт отложенный
+    from storage import JsonStorage
+    users = JsonStorage(json_path, journal_path or default_journal_path(json_path), log=log).read()
+    write_snapshot(snapshot_path, sorted(users.items()), len(users))
+    return len(users)
+
+def snapshot_to_json(snapshot_path, json_path, journal_path=None, log=None):
+    from storage import SnapshotStorage
+    users = SnapshotStorage(snapshot_path, journal_path or snapshot_path + ".journal", log=log).read()
+    try:
+        data = {str(uid): user_entry for uid, user_entry in users.all_items()}
+    finally:
+        users.close()
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+    return len(data)
+
+
+def print_log(level, user_id=None, username=None, action="", details=""):
+    print(f"{level}: {action}: {details}", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description="Преобразование снимка данных пользователей в JSON и обратно")
+    commands = parser.add_subparsers(dest="command", required=True)
+    to_snapshot = commands.add_parser("to-snapshot", help="user_data.json (с журналом) -> снимок")
+    to_snapshot.add_argument("source")
+    to_snapshot.add_argument("target")
+    to_snapshot.add_argument("--journal", help="журнал JSON (по умолчанию <source без .json>.journal)")
+    to_json = commands.add_parser("to-json", help="снимок (с журналом) -> user_data.json")
+    to_json.add_argument("source")
+    to_json.add_argument("target")
+    to_json.add_argument("--journal", help="журнал снимка (по умолчанию <source>.journal)")
+    show = commands.add_parser("show", help="заголовок снимка или запись одного пользователя")
+    show.add_argument("source")
+    show.add_argument("user_id", nargs="?", type=int)
+    args = parser.parse_args()
+
+    if args.command == "to-snapshot":
+        count = json_to_snapshot(args.source, args.target, args.journal, log=print_log)
+        print(f"Пользователей: {count}, {os.path.getsize(args.source)} -> {os.path.getsize(args.target)} байт")
+    elif args.command == "to-json":
+        count = snapshot_to_json(args.source, args.target, args.journal, log=print_log)
+        print(f"Пользователей: {count}, записано в {args.target}")
+    else:
+        reader = SnapshotReader(args.source)
+        try:
+            if args.user_id is None:
+                print(f"Версия {VERSION}, id {reader.snapshot_id}, пользователей: {len(reader)}, {len(reader.buffer)} байт")
+            else:
+                user_entry = reader.load(args.user_id)
+                if user_entry is None:
+                    print(f"Пользователь {args.user_id} не найден")
+                    return 1
+                print(json.dumps(user_entry, ensure_ascii=False, indent=4))
+        finally:
+            reader.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,40 @@
+import asyncio
+import time
+
+from aiogram import BaseMiddleware
+
+
+class StartupTimer:
+    def __init__(self, started_at):
+        self.started_at = started_at
+        self.phases = {}
+
+    def mark(self, phase):
+        self.phases[phase] = time.perf_counter() - self.started_at
+
+    def record(self, phase, seconds):
+        self.phases[phase] = seconds
+
+    def summary(self):
+        return ", ".join(f"{phase}: {seconds:.3f} с" for phase, seconds in self.phases.items())
+
+
+class ReadinessGate(BaseMiddleware):
+    # Обновления, пришедшие до прогрева хранилища, ждут здесь; после прогрева middleware снимается
+    def __init__(self):
+        self.ready = asyncio.Event()
+        self.failed = False
+        self.waited = 0
+
+    def fail(self):
+        # Хранилище не открылось: ждущие обновления отпускаются, но до обработчиков не доходят
+        self.failed = True
+        self.ready.set()
+
+    async def __call__(self, handler, event, data):
+        if not self.ready.is_set():
+            self.waited += 1
+            await self.ready.wait()
+        if self.failed:
+            return None
+        return await handler(event, data)
@@ -0,0 +1,603 @@
+import copy
+import hashlib
+import json
+import os
+import sqlite3
+import struct
+from threading import RLock
+
+from snapshot import SnapshotError, SnapshotReader, write_snapshot
+
+
+def new_user_entry():
+    return {
+        'count': 0,
+        'values': {},
+        'history': []
+    }
+
+def ensure_qr_structure(user_data_entry):
+    qr_data = user_data_entry.setdefault('qr_codes', {'next_qr_id': 1, 'codes': []})
+    qr_data.setdefault('next_qr_id', 1)
+    qr_data.setdefault('codes', [])
+
+def normalize_user_entry(user_data_entry):
+    ensure_qr_structure(user_data_entry)
+    # Старый формат хранил только последний шаг в last_additions
+    last_additions = user_data_entry.pop('last_additions', None)
+    if 'history' not in user_data_entry:
+        user_data_entry['history'] = [[[item['name'], item['value']] for item in last_additions]] if last_additions else []
+    return user_data_entry
+
+def reset_user_cycle(user_data_entry):
+    current_qr_data = user_data_entry.get('qr_codes', {'next_qr_id': 1, 'codes': []})
+    user_data_entry.update({
+        'count': 0,
+        'values': {},
+        'qr_codes': current_qr_data,
+        'history': []
+    })
+
+def apply_journal_entry(data, entry):
+    op = entry['op']
+    uid = entry['user']
+
+    if op == 'init':
+        user_entry = data.setdefault(uid, new_user_entry())
+        ensure_qr_structure(user_entry)
+    elif op == 'reset':
+        user_entry = data.setdefault(uid, new_user_entry())
+        reset_user_cycle(user_entry)
+        ensure_qr_structure(user_entry)
+    elif op == 'add':
+        user_entry = data[uid]
+        user_entry['count'] += 1
+        additions = []
+        for name, value in entry['items']:
+            user_entry['values'][name] = user_entry['values'].get(name, 0) + value
+            additions.append([name, value])
+        history = user_entry['history']
+        history.append(additions)
+        depth = entry.get('depth')
+        if depth is not None and len(history) > depth:
+            del history[:len(history) - depth]
+    elif op == 'undo':
+        user_entry = data[uid]
+        user_entry['count'] -= 1
+        history = user_entry['history']
+        for name, value in (history.pop() if history else []):
+            if name in user_entry['values']:
+                user_entry['values'][name] -= value
+        if user_entry['count'] == 0:
+            user_entry['values'] = {}
+    elif op == 'qr_add':
+        qr_data = data[uid]['qr_codes']
+        qr_data['codes'].append(dict(entry['qr']))
+        qr_data['next_qr_id'] += 1
+    elif op == 'qr_delete':
+        qr_data = data[uid]['qr_codes']
+        qr_data['codes'] = [qr for qr in qr_data['codes'] if qr['id'] != entry['id']]
+    else:
+        raise ValueError(f"Неизвестная операция журнала: {op}")
+
+
+def _no_log(*args, **kwargs):
+    pass
+
+
+class UserStorage:
+    name = None
+
+    def __init__(self, log=None):
+        self.log = log or _no_log
+        self.lock = RLock()
+
+    def open(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def load_user(self, user_id):
+        raise NotImplementedError
+
+    def iter_users(self):
+        raise NotImplementedError
+
+    def is_empty(self):
+        raise NotImplementedError
+
+    def import_users(self, users):
+        raise NotImplementedError
+
+    def apply(self, entry):
+        self.apply_batch([entry])
+
+    def apply_batch(self, entries):
+        raise NotImplementedError
+
+    def compact(self):
+        pass
+
+
+class JsonStorage(UserStorage):
+    name = "json"
+
+    def __init__(self, path, journal_path, compact_threshold=500, log=None):
+        super().__init__(log)
+        self.path = path
+        self.temp_path = os.path.splitext(path)[0] + ".tmp"
+        self.journal_path = journal_path
+        self.journal_temp_path = journal_path + ".tmp"
+        self.compact_threshold = compact_threshold
+        self.users = {}
+        self.journal_file = None
+        self.journal_entries = 0
+
+    def read(self):
+        users, snapshot_hash = self._read_snapshot()
+        try:
+            replayed = self._replay_journal(users, snapshot_hash)
+            if replayed:
+                self.log("SYSTEM", action="Загрузка журнала", details=f"Применено операций из {self.journal_path}: {replayed}")
+        except (KeyError, ValueError, IOError) as e:
+            self.log("ERROR", action="Загрузка журнала", details=f"Ошибка применения {self.journal_path}: {e}")
+
+        return users
+
+    def _read_snapshot(self):
+        users = {}
+        snapshot_hash = None
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, "rb") as f:
+                    raw = f.read()
+                snapshot_hash = hashlib.sha256(raw).hexdigest()
+                users = {int(k): normalize_user_entry(v) for k, v in json.loads(raw.decode("utf-8")).items()}
+                self.log("SYSTEM", action="Загрузка данных", details=f"Данные пользователей загружены из {self.path}")
+            else:
+                self.log("SYSTEM", action="Загрузка данных", details=f"Файл {self.path} не найден, используется пустая база.")
+        except (json.JSONDecodeError, UnicodeDecodeError, IOError) as e:
+            users = {}
+            self.log("ERROR", action="Загрузка данных", details=f"Ошибка загрузки {self.path}: {e}. Используется пустая база.")
+        return users, snapshot_hash
+
+    def _replay_journal(self, data, snapshot_hash):
+        if not os.path.exists(self.journal_path):
+            return 0
+
+        replayed = 0
+        with open(self.journal_path, "r", encoding="utf-8") as f:
+            try:
+                header = json.loads(f.readline())
+            except json.JSONDecodeError:
+                self.log("WARNING", action="Загрузка журнала", details=f"Повреждён заголовок {self.journal_path}, журнал пропущен")
+                return 0
+
+            if header.get('snapshot') != snapshot_hash:
+                self.log("INFO", action="Загрузка журнала", details=f"Журнал {self.journal_path} уже учтён в снимке, повтор не требуется")
+                return 0
+
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    self.log("WARNING", action="Загрузка журнала", details=f"Обрезанная запись журнала после {replayed} операций, остаток пропущен")
+                    break
+                apply_journal_entry(data, entry)
+                replayed += 1
+
+        return replayed
+
+    def open(self):
+        with self.lock:
+            self.users = self.read()
+            self.compact()
+
+    def close(self):
+        with self.lock:
+            self.compact()
+            if self.journal_file:
+                self.journal_file.close()
+                self.journal_file = None
+
+    def is_empty(self):
+        with self.lock:
+            return not self.users
+
+    def import_users(self, users):
+        with self.lock:
+            for uid, user_entry in users:
+                self.users[uid] = normalize_user_entry(user_entry)
+            self.compact()
+
+    def load_user(self, user_id):
+        with self.lock:
+            user_entry = self.users.get(user_id)
+            return normalize_user_entry(copy.deepcopy(user_entry)) if user_entry is not None else None
+
+    def user_ids(self):
+        with self.lock:
+            return list(self.users)
+
+    def iter_users(self):
+        for uid in self.user_ids():
+            user_entry = self.load_user(uid)
+            if user_entry is not None:
+                yield uid, user_entry
+
+    def _stage(self, entries):
+        # Пачка применяется к копиям затронутых пользователей: если запись упадет на середине,
+        # память не изменится, и повтор пачки из PersistenceWorker не применит ее начало дважды
+        staged = {}
+        for uid in {entry['user'] for entry in entries}:
+            try:
+                staged[uid] = copy.deepcopy(self.users[uid])
+            except KeyError:
+                pass
+        for entry in entries:
+            apply_journal_entry(staged, entry)
+        return staged
+
+    def apply_batch(self, entries):
+        with self.lock:
+            staged = self._stage(entries)
+            if self.journal_file is None:
+                self.users.update(staged)
+                self.compact()
+                return
+
+            try:
+                self.journal_file.write("".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries))
+                self.journal_file.flush()
+                self.journal_entries += len(entries)
+            except IOError as e:
+                self.log("ERROR", action="Запись журнала", details=f"Ошибка записи в {self.journal_path}: {e}")
+                # Сжатие сохранит пачку вместе со снимком
+                self.users.update(staged)
+                self.compact()
+                return
+            self.users.update(staged)
+
+            if self.journal_entries >= self.compact_threshold:
+                self.log("SYSTEM", action="Сжатие журнала", details=f"Накоплено операций: {self.journal_entries}")
+                self.compact()
+
+    def compact(self):
+        with self.lock:
+            try:
+                data_to_save = {str(k): v for k, v in self.users.items()}
+                raw = json.dumps(data_to_save, ensure_ascii=False, indent=4).encode("utf-8")
+                with open(self.temp_path, "wb") as f:
+                    f.write(raw)
+                os.replace(self.temp_path, self.path)
+                self._reset_journal(hashlib.sha256(raw).hexdigest())
+                self.log("SYSTEM", action="Сохранение данных", details=f"Основной файл {self.path} обновлен, журнал {self.journal_path} сброшен.")
+            except IOError as e:
+                self.log("ERROR", action="Сохранение данных", details=f"Ошибка сохранения в {self.path}: {e}")
+
+    def _reset_journal(self, snapshot_hash):
+        if self.journal_file:
+            self.journal_file.close()
+            self.journal_file = None
+
+        with open(self.journal_temp_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({'op': 'base', 'snapshot': snapshot_hash}) + "\n")
+        os.replace(self.journal_temp_path, self.journal_path)
+
+        self.journal_file = open(self.journal_path, "a", encoding="utf-8")
+        self.journal_entries = 0
+
+
+class SnapshotUsers(dict):
+    # В самом словаре только пользователи, измененные после снимка; остальные декодируются из mmap при обращении
+    def __init__(self, reader=None):
+        super().__init__()
+        self.reader = reader
+
+    def __missing__(self, user_id):
+        user_entry = self.reader.load(user_id) if self.reader is not None else None
+        if user_entry is None:
+            raise KeyError(user_id)
+        self[user_id] = user_entry
+        return user_entry
+
+    def setdefault(self, user_id, default=None):
+        try:
+            return self[user_id]
+        except KeyError:
+            self[user_id] = default
+            return default
+
+    def load(self, user_id):
+        if user_id in self:
+            return copy.deepcopy(dict.__getitem__(self, user_id))
+        return self.reader.load(user_id) if self.reader is not None else None
+
+    def user_ids(self):
+        user_ids = set(self.reader.user_ids()) if self.reader is not None else set()
+        user_ids.update(self.keys())
+        return sorted(user_ids)
+
+    def all_items(self):
+        for uid in self.user_ids():
+            yield uid, self.load(uid)
+
+    def records(self, user_ids):
+        # Неизмененные пользователи копируются в новый снимок байтами, без декодирования
+        for uid in user_ids:
+            yield uid, dict.__getitem__(self, uid) if uid in self else self.reader.raw(uid)
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+
+class SnapshotStorage(JsonStorage):
+    name = "snapshot"
+
+    def __init__(self, path, journal_path, compact_threshold=500, log=None):
+        super().__init__(path, journal_path, compact_threshold, log)
+        self.temp_path = path + ".tmp"
+        self.users = SnapshotUsers()
+
+    def _read_snapshot(self):
+        reader = None
+        try:
+            if os.path.exists(self.path):
+                reader = SnapshotReader(self.path)
+                self.log("SYSTEM", action="Загрузка данных", details=f"Открыт снимок {self.path}, пользователей: {len(reader)}")
+            else:
+                self.log("SYSTEM", action="Загрузка данных", details=f"Файл {self.path} не найден, используется пустая база.")
+        except (SnapshotError, IOError) as e:
+            self.log("ERROR", action="Загрузка данных", details=f"Ошибка загрузки {self.path}: {e}. Используется пустая база.")
+        return SnapshotUsers(reader), reader.snapshot_id if reader is not None else None
+
+    def open(self):
+        with self.lock:
+            self.users = self.read()
+            if self.users or self.users.reader is None:
+                self.compact()
+            else:
+                # Журнал ничего не изменил: снимок актуален, переписывать его при запуске незачем
+                self._reset_journal(self.users.reader.snapshot_id)
+
+    def close(self):
+        with self.lock:
+            super().close()
+            self.users.close()
+
+    def is_empty(self):
+        with self.lock:
+            return not self.users and not (self.users.reader is not None and len(self.users.reader))
+
+    def load_user(self, user_id):
+        with self.lock:
+            user_entry = self.users.load(user_id)
+            return normalize_user_entry(user_entry) if user_entry is not None else None
+
+    def user_ids(self):
+        with self.lock:
+            return self.users.user_ids()
+
+    def compact(self):
+        with self.lock:
+            try:
+                user_ids = self.users.user_ids()
+                snapshot_id = write_snapshot(self.temp_path, self.users.records(user_ids), len(user_ids))
+            except (IOError, SnapshotError, struct.error) as e:
+                self.log("ERROR", action="Сохранение данных", details=f"Ошибка сохранения в {self.path}: {e}")
+                return
+
+            # На Windows файл, открытый через mmap, нельзя заменить, поэтому старый снимок закрывается заранее
+            self.users.close()
+            try:
+                os.replace(self.temp_path, self.path)
+            except IOError as e:
+                self.log("ERROR", action="Сохранение данных", details=f"Ошибка сохранения в {self.path}: {e}")
+                self.users.reader = SnapshotReader(self.path) if os.path.exists(self.path) else None
+                return
+
+            self.users = SnapshotUsers(SnapshotReader(self.path))
+            self._reset_journal(snapshot_id)
+            self.log("SYSTEM", action="Сохранение данных", details=f"Снимок {self.path} обновлен, журнал {self.journal_path} сброшен.")
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    count INTEGER NOT NULL DEFAULT 0,
+    next_qr_id INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS category_values (
+    user_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value INTEGER NOT NULL,
+    PRIMARY KEY (user_id, name)
+);
+CREATE INDEX IF NOT EXISTS idx_category_values_position ON category_values (user_id, position);
+CREATE TABLE IF NOT EXISTS undo_history (
+    user_id INTEGER NOT NULL,
+    step INTEGER NOT NULL,
+    items TEXT NOT NULL,
+    PRIMARY KEY (user_id, step)
+);
+CREATE TABLE IF NOT EXISTS qr_codes (
+    user_id INTEGER NOT NULL,
+    qr_id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    filepath TEXT,
+    PRIMARY KEY (user_id, qr_id)
+);
+CREATE INDEX IF NOT EXISTS idx_qr_codes_text ON qr_codes (user_id, text);
+"""
+
+
+class SqliteStorage(UserStorage):
+    name = "sqlite"
+
+    def __init__(self, path, log=None):
+        super().__init__(log)
+        self.path = path
+        self.conn = None
+
+    def open(self):
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SQLITE_SCHEMA)
+        self._migrate_last_additions()
+        self.log("SYSTEM", action="Загрузка данных", details=f"Открыта база SQLite {self.path}")
+
+    def _migrate_last_additions(self):
+        if self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'last_additions'").fetchone() is None:
+            return
+        steps = {}
+        for uid, name, value in self.conn.execute("SELECT user_id, name, value FROM last_additions ORDER BY user_id, position"):
+            steps.setdefault(uid, []).append([name, value])
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany("INSERT OR IGNORE INTO undo_history (user_id, step, items) VALUES (?, 1, ?)",
+                                  [(uid, json.dumps(items, ensure_ascii=False)) for uid, items in steps.items()])
+            self.conn.execute("DROP TABLE last_additions")
+        self.log("SYSTEM", action="Миграция данных", details=f"Последние добавления перенесены в историю отмены: {len(steps)}")
+
+    def close(self):
+        with self.lock:
+            if self.conn:
+                self.conn.close()
+                self.conn = None
+
+    def is_empty(self):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None
+
+    def load_user(self, user_id):
+        with self.lock:
+            return self._load_user(user_id)
+
+    def _load_user(self, user_id):
+        row = self.conn.execute("SELECT count, next_qr_id FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            return None
+
+        values = {name: value for name, value in self.conn.execute(
+            "SELECT name, value FROM category_values WHERE user_id = ? ORDER BY position", (user_id,))}
+        history = [json.loads(items) for (items,) in self.conn.execute(
+            "SELECT items FROM undo_history WHERE user_id = ? ORDER BY step", (user_id,))]
+        codes = []
+        for qr_id, text, filepath in self.conn.execute(
+                "SELECT qr_id, text, filepath FROM qr_codes WHERE user_id = ? ORDER BY qr_id", (user_id,)):
+            qr_record = {'id': qr_id, 'text': text}
+            if filepath:
+                qr_record['filepath'] = filepath
+            codes.append(qr_record)
+
+        return {
+            'count': row[0],
+            'values': values,
+            'history': history,
+            'qr_codes': {'next_qr_id': row[1], 'codes': codes}
+        }
+
+    def iter_users(self):
+        with self.lock:
+            user_ids = self.conn.execute("SELECT user_id FROM users ORDER BY user_id").fetchall()
+        for (uid,) in user_ids:
+            user_entry = self.load_user(uid)
+            if user_entry is not None:
+                yield uid, user_entry
+
+    def apply_batch(self, entries):
+        with self.lock, self.conn:
+            self.conn.execute("BEGIN")
+            for entry in entries:
+                self._apply(entry)
+
+    def _apply(self, entry):
+        op = entry['op']
+        uid = entry['user']
+        execute = self.conn.execute
+
+        if op == 'init':
+            execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (uid,))
+        elif op == 'reset':
+            execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (uid,))
+            execute("UPDATE users SET count = 0 WHERE user_id = ?", (uid,))
+            execute("DELETE FROM category_values WHERE user_id = ?", (uid,))
+            execute("DELETE FROM undo_history WHERE user_id = ?", (uid,))
+        elif op == 'add':
+            execute("UPDATE users SET count = count + 1 WHERE user_id = ?", (uid,))
+            items = [[name, value] for name, value in entry['items']]
+            for name, value in items:
+                self._add_value(uid, name, value)
+            step = execute("SELECT COALESCE(MAX(step), 0) + 1 FROM undo_history WHERE user_id = ?", (uid,)).fetchone()[0]
+            execute("INSERT INTO undo_history (user_id, step, items) VALUES (?, ?, ?)",
+                    (uid, step, json.dumps(items, ensure_ascii=False)))
+            if entry.get('depth') is not None:
+                execute("DELETE FROM undo_history WHERE user_id = ? AND step <= ?", (uid, step - entry['depth']))
+        elif op == 'undo':
+            row = execute("SELECT step, items FROM undo_history WHERE user_id = ? ORDER BY step DESC LIMIT 1", (uid,)).fetchone()
+            if row is not None:
+                for name, value in json.loads(row[1]):
+                    execute("UPDATE category_values SET value = value - ? WHERE user_id = ? AND name = ?", (value, uid, name))
+                execute("DELETE FROM undo_history WHERE user_id = ? AND step = ?", (uid, row[0]))
+            execute("UPDATE users SET count = count - 1 WHERE user_id = ?", (uid,))
+            if execute("SELECT count FROM users WHERE user_id = ?", (uid,)).fetchone()[0] == 0:
+                execute("DELETE FROM category_values WHERE user_id = ?", (uid,))
+        elif op == 'qr_add':
+            qr = entry['qr']
+            execute("INSERT INTO qr_codes (user_id, qr_id, text, filepath) VALUES (?, ?, ?, ?)",
+                    (uid, qr['id'], qr['text'], qr.get('filepath')))
+            execute("UPDATE users SET next_qr_id = next_qr_id + 1 WHERE user_id = ?", (uid,))
+        elif op == 'qr_delete':
+            execute("DELETE FROM qr_codes WHERE user_id = ? AND qr_id = ?", (uid, entry['id']))
+        else:
+            raise ValueError(f"Неизвестная операция журнала: {op}")
+
+    def _add_value(self, uid, name, value):
+        self.conn.execute(
+            "INSERT INTO category_values (user_id, position, name, value) "
+            "VALUES (?, (SELECT COALESCE(MAX(position), 0) + 1 FROM category_values WHERE user_id = ?), ?, ?) "
+            "ON CONFLICT (user_id, name) DO UPDATE SET value = value + excluded.value",
+            (uid, uid, name, value))
+
+    def import_users(self, users):
+        with self.lock, self.conn:
+            self.conn.execute("BEGIN")
+            for uid, user_entry in users:
+                self.import_user(uid, user_entry)
+
+    def import_user(self, uid, user_entry):
+        normalize_user_entry(user_entry)
+        self.conn.execute("INSERT OR REPLACE INTO users (user_id, count, next_qr_id) VALUES (?, ?, ?)",
+                          (uid, user_entry.get('count', 0), user_entry['qr_codes']['next_qr_id']))
+        self.conn.executemany("INSERT INTO category_values (user_id, position, name, value) VALUES (?, ?, ?, ?)",
+                              [(uid, position, name, value) for position, (name, value) in enumerate(user_entry.get('values', {}).items(), 1)])
+        self.conn.executemany("INSERT INTO undo_history (user_id, step, items) VALUES (?, ?, ?)",
+                              [(uid, step, json.dumps(items, ensure_ascii=False)) for step, items in enumerate(user_entry['history'], 1)])
+        self.conn.executemany("INSERT INTO qr_codes (user_id, qr_id, text, filepath) VALUES (?, ?, ?, ?)",
+                              [(uid, qr['id'], qr['text'], qr.get('filepath')) for qr in user_entry['qr_codes']['codes']])
+
+
+def migrate_to_shard(source_users, target_storage, shard_id, shard_count):
+    # Из общей базы шард забирает только своих пользователей; сама общая база не меняется
+    shard_users = [(uid, user_entry) for uid, user_entry in source_users if uid % shard_count == shard_id]
+    target_storage.import_users(shard_users)
+    return len(shard_users)
+
+
+def migrate_json_to_snapshot(json_storage, snapshot_storage):
+    users = json_storage.read()
+    snapshot_storage.import_users(users.items())
+    return len(users)
+
+def migrate_json_to_sqlite(json_storage, sqlite_storage):
+    users = json_storage.read()
+    with sqlite_storage.lock, sqlite_storage.conn:
+        sqlite_storage.conn.execute("BEGIN")
+        for uid, user_entry in users.items():
+            sqlite_storage.import_user(uid, user_entry)
+    return len(users)
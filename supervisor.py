@@ -0,0 +1,231 @@
+import asyncio
+import multiprocessing
+import os
+import signal
+import time
+
+from aiogram import Bot
+from aiohttp import web
+from dotenv import load_dotenv
+
+from logger import Colors, configure_logging, log_message, shutdown_logging
+
+load_dotenv()
+
+SHARD_WORKERS = max(1, int(os.getenv("SHARD_WORKERS", str(os.cpu_count() or 1))))
+SHARD_DRAIN_TIMEOUT = float(os.getenv("SHARD_DRAIN_TIMEOUT", "30"))
+SHARD_RESTART_DELAY = float(os.getenv("SHARD_RESTART_DELAY", "1"))
+POLLING_TIMEOUT = 30
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9101"))
+LOG_DIR = os.path.join("logs", "supervisor")
+
+
+def update_user_id(update):
+    for key, event in update.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        user = event.get("from") or event.get("user") or event.get("chat")
+        if isinstance(user, dict) and "id" in user:
+            return user["id"]
+    # Обновления без пользователя (например, опросы) всегда уходят в нулевой шард
+    return 0
+
+def run_worker(shard_id, shard_count, inbox):
+    # Ctrl+C получает вся группа процессов, а останавливать шарды должен supervisor, чтобы они успели доработать
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    os.environ.update({
+        "BOT_MODE": "shard",
+        "SHARD_ID": str(shard_id),
+        "SHARD_COUNT": str(shard_count),
+        # Общий лимит Telegram на бота делится между процессами
+        "SEND_GLOBAL_RATE": str(SEND_GLOBAL_RATE / shard_count),
+        "METRICS_PORT": str(METRICS_PORT + 1 + shard_id),
+    })
+    import bot
+    asyncio.run(bot.run_shard(inbox))
+
+
+class ShardWorker:
+    def __init__(self, context, shard_id, shard_count):
+        self.context = context
+        self.shard_id = shard_id
+        self.shard_count = shard_count
+        # Очередь живет дольше процесса: обновления, пришедшие во время перезапуска, дождутся нового
+        self.inbox = context.Queue()
+        self.process = None
+        self.draining = False
+        self.restarts = 0
+        self.started_at = 0.0
+
+    def start(self):
+        self.process = self.context.Process(target=run_worker, name=f"counter-shard-{self.shard_id}",
+                                            args=(self.shard_id, self.shard_count, self.inbox))
+        self.process.start()
+        self.started_at = time.monotonic()
+        self.draining = False
+        log_message("SYSTEM", action="Шард запущен", details=f"Шард {self.shard_id}, PID {self.process.pid}")
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    async def drain(self, timeout=SHARD_DRAIN_TIMEOUT):
+        if self.process is None:
+            return
+        self.draining = True
+        if self.process.is_alive():
+            self.inbox.put(None)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.process.join, timeout)
+        if self.process.is_alive():
+            log_message("WARNING", action="Остановка шарда", details=f"Шард {self.shard_id} не завершился за {timeout} с, принудительная остановка")
+            self.process.terminate()
+            await loop.run_in_executor(None, self.process.join)
+        log_message("SYSTEM", action="Шард остановлен", details=f"Шард {self.shard_id}, код выхода {self.process.exitcode}")
+        self.process = None
+
+    async def restart(self):
+        await self.drain()
+        self.restarts += 1
+        self.start()
+
+
+class Supervisor:
+    def __init__(self, shard_count):
+        self.context = multiprocessing.get_context("spawn")
+        self.workers = [ShardWorker(self.context, shard_id, shard_count) for shard_id in range(shard_count)]
+        self.bot = None
+        self.stopping = asyncio.Event()
+        self.restart_lock = asyncio.Lock()
+        self.routed = 0
+        self.offset = None
+
+    def route(self, update):
+        worker = self.workers[update_user_id(update) % len(self.workers)]
+        worker.inbox.put(update)
+        self.routed += 1
+
+    async def rolling_restart(self):
+        # Шарды перезапускаются по одному: остальные в это время продолжают отвечать
+        async with self.restart_lock:
+            log_message("SYSTEM", action="Перезапуск шардов", details=f"Поочередный перезапуск {len(self.workers)} шардов")
+            for worker in self.workers:
+                if self.stopping.is_set():
+                    return
+                await worker.restart()
+
+    async def watch_workers(self):
+        while not self.stopping.is_set():
+            await asyncio.sleep(1)
+            if self.restart_lock.locked():
+                continue
+            for worker in self.workers:
+                if worker.draining or worker.is_alive():
+                    continue
+                exitcode = worker.process.exitcode if worker.process else None
+                # Шард, падающий сразу после старта, перезапускается не чаще SHARD_RESTART_DELAY
+                if time.monotonic() - worker.started_at < SHARD_RESTART_DELAY:
+                    continue
+                log_message("ERROR", action="Шард упал", details=f"Шард {worker.shard_id}, код выхода {exitcode}, перезапуск")
+                worker.restarts += 1
+                worker.start()
+
+    async def poll_updates(self):
+        while not self.stopping.is_set():
+            try:
+                updates = await self.bot.get_updates(offset=self.offset, timeout=POLLING_TIMEOUT)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log_message("ERROR", action="Получение обновлений", details=str(e))
+                await asyncio.sleep(SHARD_RESTART_DELAY)
+                continue
+            for update in updates:
+                self.offset = update.update_id + 1
+                self.route(update.model_dump(mode="json", exclude_none=True, by_alias=True))
+
+    async def handle_webhook(self, request):
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        self.route(await request.json())
+        return web.Response()
+
+    async def receive_updates(self):
+        if BOT_MODE == "webhook":
+            app = web.Application()
+            app.router.add_post(WEBHOOK_PATH, self.handle_webhook)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            try:
+                await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+                if WEBHOOK_URL:
+                    await self.bot.set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None)
+                log_message("SYSTEM", action="Webhook", details=f"Сервер слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+                await self.stopping.wait()
+            finally:
+                await runner.cleanup()
+            return
+
+        polling = asyncio.create_task(self.poll_updates())
+        await self.stopping.wait()
+        polling.cancel()
+        try:
+            await polling
+        except asyncio.CancelledError:
+            pass
+        if self.offset is not None:
+            # Telegram считает обновления доставленными только при следующем запросе со сдвигом,
+            # без него последняя пачка пришла бы повторно после перезапуска
+            try:
+                await self.bot.get_updates(offset=self.offset, timeout=0, limit=1)
+            except Exception as e:
+                log_message("WARNING", action="Получение обновлений", details=f"Не удалось подтвердить последние обновления: {e}")
+
+    def install_signal_handlers(self):
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGTERM, self.stopping.set)
+            loop.add_signal_handler(signal.SIGINT, self.stopping.set)
+            loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(self.rolling_restart()))
+        except (NotImplementedError, AttributeError):
+            # На Windows сигналов в цикле событий нет: остановка по Ctrl+C, перезапуск только после падения
+            pass
+
+    async def run(self):
+        self.bot = Bot(token=os.getenv("BOT_TOKEN"))
+        self.install_signal_handlers()
+        for worker in self.workers:
+            worker.start()
+        watcher = asyncio.create_task(self.watch_workers())
+        try:
+            await self.receive_updates()
+        finally:
+            self.stopping.set()
+            watcher.cancel()
+            log_message("SYSTEM", action="Остановка", details=f"Передано обновлений: {self.routed}, дорабатываем шарды")
+            await asyncio.gather(*(worker.drain() for worker in self.workers))
+            await self.bot.session.close()
+
+
+def main():
+    configure_logging(os.getenv("LOG_LEVEL", "INFO"), LOG_DIR)
+    if not os.getenv("BOT_TOKEN"):
+        print(f"{Colors.RED}Ошибка: BOT_TOKEN не найден. Пожалуйста, создайте файл .env и добавьте BOT_TOKEN=<ВАШ_ТОКЕН>{Colors.RESET}")
+        return
+    print(f"\n{Colors.BOLD}{Colors.GREEN}==== Бот для подсчета сумм: {SHARD_WORKERS} шард(ов) ===={Colors.RESET}\n")
+    supervisor = Supervisor(SHARD_WORKERS)
+    try:
+        asyncio.run(supervisor.run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shutdown_logging()
+
+if __name__ == '__main__':
+    main()